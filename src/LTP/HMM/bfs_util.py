@@ -1,5 +1,8 @@
 import numpy as np
 
+from .util import safe_log, logExpSum
+
+
 def generate_states(T, max_level, delta_level):
     states = []
     for t in range(T):
@@ -21,34 +24,8 @@ def generate_states(T, max_level, delta_level):
     return np.array(states)
 
 
-def survivial_llk(h, H):
-    # h, T*1 hazard rate
-    # T, spell length
-    # H, whether right censored
-    T = len(h)
-    if T == 1:
-        base_prob = 1
-    else:
-        # has survived T-1 period
-        base_prob = np.product(1 - h[:-1])
-
-    prob = base_prob * (H * h[-1] + (1 - H) * (1 - h[-1]))
-    return prob
-
-
-def state_llk(X, J, E, init_dist, transit_matrix):
-    # X: vector of latent state, list
-    # transit matrix is np array [t-1,t]
-    # if X[0] == 1:
-    prob = init_dist[X[0]] * np.product(
-        [transit_matrix[J[t - 1], E[t - 1], X[t - 1], X[t]] for t in range(1, len(X))]
-    )
-
-    return prob
-
-
-def likelihood(
-    X,
+def get_llk_all_states(
+    X_mat,
     O,
     E,
     H,
@@ -63,92 +40,58 @@ def likelihood(
     is_exit,
     hazard_state,
 ):
-    # X:  Latent state
+    # log likelihood of each path, N_X*1
+    # X_mat: N_X*T latent paths
     # O: observation
     # H: binary indicator, whether the spell is ended
     # E: binary indicator, whether effort is exerted
+    X_mat = np.asarray(X_mat, dtype=int)
+    T = X_mat.shape[1]
+    O = np.array(O, dtype=int)
+    E = np.array(E, dtype=int)
+    J = np.array(J, dtype=int)
+    item_ids = np.array(item_ids, dtype=int)
+    t_idx = np.arange(T)
 
-    T = len(X)
     # P(H|X)
     if is_exit:
         if hazard_state == "X":
-            h = np.array([hazard_matrix[X[t], t] for t in range(T)])
+            h = hazard_matrix[X_mat, t_idx]
         elif hazard_state == "Y":
-            h = np.array([hazard_matrix[O[t], t] for t in range(T)])
-        ph = survivial_llk(h, H)
+            h = hazard_matrix[O, t_idx][None, :]
+        else:
+            raise Exception("Unknown dependent states! %s " % hazard_state)
+        # has survived T-1 period
+        ph = safe_log(1 - h[:, :-1]).sum(axis=1) + safe_log(
+            H * h[:, -1] + (1 - H) * (1 - h[:, -1])
+        )
     else:
-        ph = 1
+        ph = 0.0
 
     # P(O|X)
-    po = 1
-    pe = 1
+    po = safe_log(observ_prob_matrix[item_ids, X_mat, O])
     # P(E|X)
     if is_effort:
         # The effort is generated base on the initial X.
-        for t in range(T):
-            pe *= effort_prob_matrix[J[t], X[t], E[t]]
-
-        for t in range(T):
-            if E[t] != 0:
-                po *= observ_prob_matrix[item_ids[t], X[t], O[t]]
-            else:
-                po *= 1.0 if O[t] == 0 else 0.0  # this is a strong built in restriction
+        pe = safe_log(effort_prob_matrix[J, X_mat, E]).sum(axis=1)
+        # no effort implies a zero response, a strong built in restriction
+        po = np.where(E != 0, po, np.where(O == 0, 0.0, -np.inf))
     else:
-        E = [1 for x in X]
-        for t in range(T):
-            po *= observ_prob_matrix[item_ids[t], X[t], O[t]]
+        E = np.ones(T, dtype=int)
+        pe = 0.0
+    po = po.sum(axis=1)
 
     # P(X)
-    px = state_llk(X, J, E, state_init_dist, state_transit_matrix)
+    px = safe_log(state_init_dist[X_mat[:, 0]]) + safe_log(
+        state_transit_matrix[J[:-1], E[:-1], X_mat[:, :-1], X_mat[:, 1:]]
+    ).sum(axis=1)
 
-    lk = ph * po * px * pe
+    llk_vec = ph + po + px + pe
 
-    if lk < 0:
-        raise ValueError("Negative likelihood.")
+    if np.isnan(llk_vec).any():
+        raise ValueError("Invalid likelihood.")
 
-    return lk
-
-
-def get_llk_all_states(
-    X_mat,
-    O,
-    E,
-    H,
-    J,
-    item_ids,
-    hazard_matrix,
-    observ_prob_matrix,
-    state_init_dist,
-    state_transit_matrix,
-    effort_prob_matrix,
-    is_effort,
-    is_exit,
-    hazard_state,
-):
-    N_X = X_mat.shape[0]
-    llk_vec = []
-    for i in range(N_X):
-        X = [int(x) for x in X_mat[i, :].tolist()]
-        llk_vec.append(
-            likelihood(
-                X,
-                O,
-                E,
-                H,
-                J,
-                item_ids,
-                hazard_matrix,
-                observ_prob_matrix,
-                state_init_dist,
-                state_transit_matrix,
-                effort_prob_matrix,
-                is_effort,
-                is_exit,
-                hazard_state,
-            )
-        )
-
-    return np.array(llk_vec)
+    return llk_vec
 
 
 def get_single_state_llk(X_mat, llk_vec, t, x):
@@ -182,7 +125,7 @@ def update_state_parmeters(
 ):
     # calculate the exhaustive state probablity
     Ti = len(O)
-    llk_vec = get_llk_all_states(
+    log_llk_vec = get_llk_all_states(
         X_mat,
         O,
         E,
@@ -199,32 +142,38 @@ def update_state_parmeters(
         hazard_state,
     )
 
-    if abs(llk_vec.sum()) < 1e-40:
+    tot_log_llk = logExpSum(log_llk_vec)
+    if tot_log_llk == -np.inf:
         raise ValueError("All likelihood are 0.")
 
+    # normalize in the log space, llk_vec is the posterior of the paths
+    llk_vec = np.exp(log_llk_vec - tot_log_llk)
+
     # pi
-    tot_llk = llk_vec.sum()
-    pis = [get_single_state_llk(X_mat, llk_vec, Ti - 1, x) / tot_llk for x in range(Mx)]
+    X_mat = np.asarray(X_mat, dtype=int)
+    pis = np.bincount(X_mat[:, Ti - 1], weights=llk_vec, minlength=Mx).tolist()
 
     # learning rate
-    l_mat = np.zeros((Ti, Mx, Mx))  # T,X_{t+1},X_t
-    for t in range(Ti - 1, 0, -1):
-        l_mat[t, 0, 0] = 1  # the 0 state in t, must implies 0 in t-1
-        for m in range(1, Mx):
-            pNext = get_single_state_llk(X_mat, llk_vec, t, m)
-            if pNext != 0:
-                for n in range(Mx):
-                    # P(X_{t-1},X_t)/P(X_t)
-                    l = get_joint_state_llk(X_mat, llk_vec, t, n, m) / pNext
-                    if not (l >= 0 and l <= 1):
-                        if not (l > 1 and l - 1 < 0.00001):
-                            raise ValueError("Learning rate is wrong for X=%d." % x)
-                        else:
-                            l = 1.0
-                    l_mat[t, m, n] = l
-            # If pNext is 0, then there is no probability the state will transite in
-
-    return llk_vec, pis, l_mat
+    # joint posterior of (X_{t-1},X_t), one bincount cell per (t,X_{t-1},X_t)
+    cells = (np.arange(1, Ti) * Mx * Mx) + X_mat[:, :-1] * Mx + X_mat[:, 1:]
+    joint_mat = np.bincount(
+        cells.ravel(), weights=np.repeat(llk_vec, Ti - 1), minlength=Ti * Mx * Mx
+    ).reshape(Ti, Mx, Mx)
+    # P(X_t)
+    p_next = joint_mat.sum(axis=1)[:, :, None]
+
+    # P(X_{t-1},X_t)/P(X_t), T,X_{t+1},X_t
+    # If P(X_t) is 0, then there is no probability the state will transite in
+    with np.errstate(divide="ignore", invalid="ignore"):
+        l_mat = np.where(p_next != 0, joint_mat.transpose(0, 2, 1) / p_next, 0.0)
+    if ((l_mat < 0) | (l_mat > 1.00001)).any():
+        raise ValueError("Learning rate is wrong.")
+    l_mat = np.minimum(l_mat, 1.0)
+    # the 0 state in t, must implies 0 in t-1
+    l_mat[:, 0, :] = 0
+    l_mat[1:, 0, 0] = 1
+
+    return log_llk_vec, pis, l_mat
 
 
 if __name__ == "__main__":
@@ -297,6 +246,10 @@ if __name__ == "__main__":
         hazard_state="Y",
     )
 
+    # back to the probability scale
+    llk_vec_null, llk_vec_X, llk_vec_Y = [
+        np.exp(llk_vec) for llk_vec in [llk_vec_null, llk_vec_X, llk_vec_Y]
+    ]
     l_null = get_joint_state_llk(X_mat, llk_vec_null, 1, 0, 1) / get_single_state_llk(
         X_mat, llk_vec_null, 0, 0
     )
@@ -0,0 +1,338 @@
+import json
+import os
+
+import numpy as np
+
+LOG_HEADER_FILE = "header.json"
+
+
+class RaggedSeq(object):
+    """
+    K sequences of unequal length, stored flat.
+
+    The period t of sequence k sits at offsets[k] + t of every field, so the
+    storage grows with the number of logs instead of K * max(T).
+    """
+
+    def __init__(self, offsets, fields, seq_index=None, t_index=None):
+        # offsets: K+1 int array
+        # fields: {name: flat array of size offsets[-1]}
+        # seq_index, t_index: the index arrays of the same offsets, if known
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.fields = dict(fields)
+        self.lengths = np.diff(self.offsets).astype(np.int32)
+        # sequence id and period of each flat position
+        if seq_index is None or t_index is None:
+            seq_index = np.repeat(
+                np.arange(len(self.lengths), dtype=np.int32), self.lengths
+            )
+            t_index = (
+                np.arange(self.size, dtype=np.int64)
+                - np.repeat(self.offsets[:-1], self.lengths)
+            ).astype(np.int32)
+        self.seq_index = seq_index
+        self.t_index = t_index
+
+    @classmethod
+    def from_logs(cls, seq_ids, t_ids, fields, dtypes={}):
+        # seq_ids: sequence id from 0:K-1, t_ids: period from 0
+        # fields: {name: value of each log}, missing periods are 0
+        seq_ids = np.asarray(seq_ids, dtype=np.int64)
+        t_ids = np.asarray(t_ids, dtype=np.int64)
+        if seq_ids.size and (seq_ids.min() < 0 or t_ids.min() < 0):
+            raise ValueError("The sequence and period ids cannot be negative.")
+        K = int(seq_ids.max()) + 1 if seq_ids.size else 0
+        lengths = np.zeros(K, dtype=np.int64)
+        np.maximum.at(lengths, seq_ids, t_ids + 1)
+        # an id without logs would be an empty sequence, e.g. a phantom learner
+        if np.any(lengths == 0):
+            raise ValueError(
+                "The sequence ids are not continuous from 0. Sequence %d has no log."
+                % np.flatnonzero(lengths == 0)[0]
+            )
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+
+        pos = offsets[seq_ids] + t_ids
+        flat_fields = {}
+        for name, values in fields.items():
+            values = np.asarray(values)
+            flat_fields[name] = np.zeros(
+                offsets[-1], dtype=dtypes.get(name, values.dtype)
+            )
+            flat_fields[name][pos] = values
+        return cls(offsets, flat_fields)
+
+    @property
+    def num_seq(self):
+        return len(self.lengths)
+
+    @property
+    def max_len(self):
+        return int(self.lengths.max()) if self.num_seq else 0
+
+    @property
+    def size(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, name):
+        return self.fields[name]
+
+    def get_seq(self, name, k):
+        return self.fields[name][self.offsets[k] : self.offsets[k + 1]]
+
+    def get_last(self, name):
+        # the value at the last period of each sequence
+        return self.fields[name][self.offsets[1:] - 1]
+
+    def has_next(self):
+        # whether the flat position is followed by a period of the same sequence
+        return self.t_index < self.lengths[self.seq_index] - 1
+
+    def to_dense(self, name, fill=0):
+        # T*K array, padded with fill after the end of each sequence
+        # name is a field, or flat values stored as the fields
+        values = self.fields[name] if isinstance(name, str) else np.asarray(name)
+        dense = np.full((self.max_len, self.num_seq), fill, dtype=values.dtype)
+        dense[self.t_index, self.seq_index] = values
+        return dense
+
+    def sort_by(self, name):
+        # reorder the periods within each sequence by the value of a field
+        order = np.lexsort((self.fields[name], self.seq_index))
+        return RaggedSeq(
+            self.offsets,
+            {key: arr[order] for key, arr in self.fields.items()},
+            self.seq_index,
+            self.t_index,
+        )
+
+    def get_arrays(self):
+        # the index arrays are kept so that the mapped copy does not rebuild them
+        arrays = {
+            "offsets": self.offsets,
+            "seq_index": self.seq_index,
+            "t_index": self.t_index,
+        }
+        arrays.update(self.fields)
+        return arrays
+
+
+def get_log_columns(data, names, defaults={}, is_strict=True):
+    """
+    Split the logs into one array per column.
+
+    data is either a structured array or a dict of arrays with a field per
+    name, a 2-D array with a column per name, or a list of tuples. The
+    trailing columns that are absent take their value in defaults. Unless
+    is_strict, the columns beyond names are ignored.
+    """
+    if isinstance(data, np.ndarray) and data.dtype.names is not None:
+        return _get_named_columns(data, data.dtype.names, names, defaults)
+    if isinstance(data, dict):
+        return _get_named_columns(data, data.keys(), names, defaults)
+
+    min_width = len(names) - len(defaults)
+    if not isinstance(data, np.ndarray):
+        # tuple list: convert the rows of each width as one block
+        widths = set(map(len, data))
+        if len(widths) > 1:
+            blocks = [
+                get_log_columns(
+                    [log for log in data if len(log) == w], names, defaults, is_strict
+                )
+                for w in sorted(widths)
+            ]
+            # the order of the rows is irrelevant to the loaders
+            return {
+                name: np.concatenate([block[name] for block in blocks])
+                for name in names
+            }
+        data = np.array(data) if data else np.empty((0, min_width), dtype=np.int64)
+
+    if data.ndim == 2 and not is_strict:
+        data = data[:, : len(names)]
+    if data.ndim != 2 or not min_width <= data.shape[1] <= len(names):
+        raise Exception("The log format is not recognized.")
+    columns = {}
+    for k, name in enumerate(names):
+        if k < data.shape[1]:
+            columns[name] = data[:, k]
+        else:
+            columns[name] = np.full(data.shape[0], defaults[name])
+    return columns
+
+
+def _get_named_columns(data, fields, names, defaults):
+    columns = {}
+    for name in names:
+        if name in fields:
+            columns[name] = np.asarray(data[name])
+        elif name in defaults:
+            columns[name] = np.full(len(data[names[0]]), defaults[name])
+        else:
+            raise Exception("The log format is not recognized.")
+    return columns
+
+
+def count_unique(values):
+    # the number of distinct values, without a sort for non-negative ints
+    values = np.asarray(values)
+    if values.size and values.dtype.kind in "iu" and values.min() >= 0:
+        return int(np.count_nonzero(np.bincount(values)))
+    return len(np.unique(values))
+
+
+def get_min_int_dtype(values):
+    # the smallest int dtype that holds all the values
+    for dtype in [np.int8, np.int16, np.int32]:
+        if values.size == 0 or (
+            values.min() >= np.iinfo(dtype).min and values.max() <= np.iinfo(dtype).max
+        ):
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def write_log_columns(data, dir_path, names, id_names=[]):
+    """
+    Save the logs as one .npy file per column under dir_path, with a JSON header.
+
+    data: list of tuples, or column arrays as accepted by get_log_columns
+    names: the name of each column, in the order of the tuple
+    id_names: the columns of raw ids (e.g. strings), stored as the codes 0:N-1
+        with the raw ids of the codes in the header
+    """
+    if isinstance(data, list):
+        # convert per column so that the string ids do not cast the rest
+        if not data or any(len(log) != len(names) for log in data):
+            raise Exception("The log format is not recognized.")
+        columns = {name: np.asarray(col) for name, col in zip(names, zip(*data))}
+    else:
+        columns = get_log_columns(data, names)
+
+    os.makedirs(dir_path, exist_ok=True)
+    header = {"num_log": len(columns[names[0]]), "names": list(names), "id_dict": {}}
+    for name in names:
+        values = columns[name]
+        if name in id_names:
+            raw_ids, values = np.unique(values, return_inverse=True)
+            header["id_dict"][name] = raw_ids.tolist()
+        elif values.dtype.kind not in "iub":
+            raise Exception("Column %s is not an integer. Add it to id_names." % name)
+        values = values.astype(get_min_int_dtype(values))
+        np.save(os.path.join(dir_path, "%s.npy" % name), values)
+
+    with open(os.path.join(dir_path, LOG_HEADER_FILE), "w") as f:
+        json.dump(header, f)
+    return header
+
+
+def load_log_columns(dir_path):
+    """
+    Map the columns saved by write_log_columns read-only.
+
+    return the columns, which every estimator accepts in place of the tuples,
+    and the raw ids of the coded columns as {name: [raw id of code 0, ...]}
+    """
+    with open(os.path.join(dir_path, LOG_HEADER_FILE)) as f:
+        header = json.load(f)
+    columns = {
+        name: np.load(os.path.join(dir_path, "%s.npy" % name), mmap_mode="r")
+        for name in header["names"]
+    }
+    return columns, header["id_dict"]
+
+
+def get_pattern_index(pattern_mat):
+    # pattern_mat: N*D int array, one row per sequence, padded with -1
+    # return the unique rows, their counts and the row -> pattern index
+    patterns, pattern_ref, pattern_cnt = np.unique(
+        pattern_mat, axis=0, return_inverse=True, return_counts=True
+    )
+    return patterns, pattern_cnt, pattern_ref.reshape(-1)
+
+
+def get_ragged_pattern_index(data, names, seq_key=None):
+    # collapse the sequences with identical values of the fields in names
+    # seq_key: an int of each sequence that is also part of the pattern
+    # return the patterns as a RaggedSeq, their seq_key, their counts and the
+    # sequence -> pattern index
+    # sequences of the same length are compared as one dense block
+    order = np.argsort(data.lengths, kind="stable")
+    uniq_lengths, starts = np.unique(data.lengths[order], return_index=True)
+    ends = np.append(starts[1:], data.num_seq)
+
+    pattern_ref = np.empty(data.num_seq, dtype=np.int64)
+    pattern_cnt = []
+    pattern_key = []
+    pattern_lengths = []
+    pattern_fields = {name: [] for name in names}
+    num_pattern = 0
+    for L, start, end in zip(uniq_lengths, starts, ends):
+        members = order[start:end]
+        pos = data.offsets[members, None] + np.arange(L)
+        block = [data[name][pos].astype(np.int64) for name in names]
+        if seq_key is not None:
+            block = [np.asarray(seq_key)[members, None]] + block
+        patterns, cnt, ref = get_pattern_index(np.hstack(block))
+
+        pattern_ref[members] = num_pattern + ref
+        pattern_cnt.append(cnt)
+        pattern_lengths.append(np.full(len(cnt), L))
+        if seq_key is not None:
+            pattern_key.append(patterns[:, 0])
+            patterns = patterns[:, 1:]
+        for i, name in enumerate(names):
+            pattern_fields[name].append(patterns[:, i * L : (i + 1) * L].reshape(-1))
+        num_pattern += len(cnt)
+
+    offsets = np.concatenate([[0], np.cumsum(np.concatenate(pattern_lengths))])
+    pattern_data = RaggedSeq(
+        offsets,
+        {
+            name: np.concatenate(pattern_fields[name]).astype(data[name].dtype)
+            for name in names
+        },
+    )
+    pattern_key = np.concatenate(pattern_key) if seq_key is not None else None
+    return pattern_data, pattern_key, np.concatenate(pattern_cnt), pattern_ref
+
+
+def pack_shared_data(data):
+    # flatten the ragged fields into plain arrays to dump as files
+    arrays = {}
+    for name, value in data.items():
+        if isinstance(value, RaggedSeq):
+            for key, arr in value.get_arrays().items():
+                arrays["%s.%s" % (name, key)] = arr
+        else:
+            arrays[name] = value
+    return arrays
+
+
+def unpack_shared_data(arrays):
+    # rebuild the ragged fields from the mapped arrays
+    data = {}
+    ragged = {}
+    for name, arr in arrays.items():
+        if "." in name:
+            name, key = name.split(".", 1)
+            ragged.setdefault(name, {})[key] = arr
+        else:
+            data[name] = arr
+    for name, fields in ragged.items():
+        offsets = fields.pop("offsets")
+        seq_index = fields.pop("seq_index", None)
+        t_index = fields.pop("t_index", None)
+        data[name] = RaggedSeq(offsets, fields, seq_index, t_index)
+    return data
+
+
+if __name__ == "__main__":
+    # two learners with 3 and 1 periods
+    seq = RaggedSeq.from_logs(
+        [0, 0, 0, 1], [0, 1, 2, 0], {"O": [1, 0, 1, 1]}, {"O": np.int8}
+    )
+    print(seq.offsets, seq["O"], seq.t_index, seq.has_next())
+    print([0, 3, 4], [1, 0, 1, 1], [0, 1, 2, 0], [True, True, False, False])
+    print(seq.to_dense("O", -1))
+    print(np.array([[1, 1], [0, -1], [1, -1]]))
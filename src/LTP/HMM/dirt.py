@@ -1,119 +1,158 @@
-from collections import defaultdict
 import copy
 
 import numpy as np
-from joblib import Parallel, delayed
 from tqdm import tqdm
 
-from .util import draw_c, random_choice, get_item_dict
+from .util import draw_c, random_choice_batch, get_item_dict, count_cell
+from .util import set_rng_state, save_checkpoint, init_param_chain, MCMC_Chain
+from .data_util import RaggedSeq, get_ragged_pattern_index
+from .data_util import get_log_columns, count_unique
 from .dirt_util import filter_invalid_items, data_etl
 from .dirt_util import update_state_parmeters, generate_states, get_final_chain
 from .dirt_util import get_map_estimation, get_percentile_estimation
 
 
-class DIRT_MCMC(object):
+class DIRT_MCMC(MCMC_Chain):
+    # the sampler state saved in a checkpoint besides the chain and the rng
+    chain_state_fields = [
+        "state_init_dist",
+        "observ_prob_matrix",
+        "effort_prob_matrix",
+        "prior_param",
+        "unique_item_num",
+        "item_param_dict",
+    ]
+
+    # observation arrays the parallel workers map from files
+    shared_data_fields = [
+        "observ_data",
+        "obs_type_patterns",
+        "obs_type_cnt",
+        "obs_type_ref",
+    ]
+
     def _load_observ(self, data):
         """
         THe input data needs to be sorted by learner id and t
         """
 
-        self.K = len(set([x[0] for x in data]))  # i
-        self.T = max([x[1] for x in data]) + 1  # t
-        self.J = len(set([x[2] for x in data]))  # j
-        self.My = len(set(x[3] for x in data))  # y
-
-        self.E_array = np.empty((self.T, self.K), dtype=np.int)
-        self.O_array = np.empty((self.T, self.K), dtype=np.int)
-        self.J_array = np.empty((self.T, self.K), dtype=np.int)
-        T_array = np.zeros((self.K,))
-
-        for log in data:
-            if len(log) == 4:
-                # The spell never ends; multiple item
-                i, t, j, y = log
-                is_e = 1
-            elif len(log) == 5:
-                i, t, j, y, is_e = log
-            else:
-                raise Exception("The log format is not recognized.")
-            self.O_array[t, i] = y
-            self.J_array[t, i] = j
-            self.E_array[t, i] = is_e
-            T_array[i] = max(T_array[i], t)  # in case the data are not properly sorted!
-
-        # This section is used to collapse states
-        self.T_vec = [int(x) + 1 for x in T_array.tolist()]
-        self.O_data = []
-        for i in range(self.K):
-            self.O_data.append([x for x in self.O_array[0 : self.T_vec[i], i].tolist()])
-        self.J_data = []
-        for i in range(self.K):
-            self.J_data.append([x for x in self.J_array[0 : self.T_vec[i], i].tolist()])
-        self.E_data = []
-        for i in range(self.K):
-            self.E_data.append([x for x in self.E_array[0 : self.T_vec[i], i].tolist()])
-
-        # check for integrity
+        logs = get_log_columns(data, ["i", "t", "j", "y", "e"], {"e": 1})
+        self.J = count_unique(logs["j"])  # j
+        self.My = count_unique(logs["y"])  # y
+
+        # the logs of each learner are stored back to back, without padding
+        # the spell length is the largest t, in case the data are not sorted
+        self.observ_data = RaggedSeq.from_logs(
+            logs["i"],
+            logs["t"],
+            {"O": logs["y"], "J": logs["j"], "E": logs["e"]},
+            {"O": np.int8, "J": np.int32, "E": np.int8},
+        )
+        self.K = self.observ_data.num_seq  # i
+        self.T = self.observ_data.max_len  # t
 
     def _collapse_obser_state(self):
-        self.obs_type_cnt = defaultdict(int)
-        self.obs_type_ref = {}
-
         """
         ORDER NO LONGER MATTERS!
         Sort everything by item ids
         Do not allow for multiple records of the same learner/item
         """
-        for k in range(self.K):
-            item_id_list = self.J_data[k]
-            num_item = len(item_id_list)
-            if num_item != len(set(item_id_list)):
-                raise Exception(
-                    "Duplicated log found in data. Each learner/item pair can have only 1 record!"
-                )
-            item_sort_idx = sorted(range(num_item), key=lambda j: item_id_list[j])
-            obs_type_key = (
-                "|".join(str(self.O_data[k][idx]) for idx in item_sort_idx)
-                + "-"
-                + "|".join(str(item_id_list[idx]) for idx in item_sort_idx)
-                + "-"
-                + "|".join(str(self.E_data[k][idx]) for idx in item_sort_idx)
+        data = self.observ_data.sort_by("J")
+        is_same_learner = data.seq_index[1:] == data.seq_index[:-1]
+        if np.any(is_same_learner & (data["J"][1:] == data["J"][:-1])):
+            raise Exception(
+                "Duplicated log found in data. Each learner/item pair can have only 1 record!"
             )
-            self.obs_type_cnt[obs_type_key] += 1
-            self.obs_type_ref[k] = obs_type_key
 
-        # construct the space
+        (
+            self.obs_type_patterns,
+            _,
+            self.obs_type_cnt,
+            self.obs_type_ref,
+        ) = get_ragged_pattern_index(data, ["O", "J", "E"])
+        self.obs_type_info = None
+
+    def _build_obs_type_info(self):
+        # construct the space, converting each field once instead of per pattern
+        patterns = self.obs_type_patterns
+        bounds = patterns.offsets.tolist()
+        fields = {name: patterns[name].tolist() for name in ["O", "J", "E"]}
         self.obs_type_info = {}
-        for key in self.obs_type_cnt.keys():
-            O_s, J_s, E_s = key.split("-")
+        for key in range(patterns.num_seq):
+            start, end = bounds[key], bounds[key + 1]
             self.obs_type_info[key] = {
-                "O": [int(x) for x in O_s.split("|")],
-                "J": [int(x) for x in J_s.split("|")],
-                "E": [int(x) for x in E_s.split("|")],
+                "O": fields["O"][start:end],
+                "J": fields["J"][start:end],
+                "E": fields["E"][start:end],
             }
 
-    def _MCMC(self, max_iter, is_effort=False, is_robust=False):
+    def _MCMC(
+        self,
+        max_iter,
+        is_effort=False,
+        is_robust=False,
+        checkpoint_file=None,
+        checkpoint_every=100,
+        chain_state=None,
+        chain_file=None,
+        stop_iter=None,
+    ):
         # initialize for iteration
+        if self.obs_type_info is None:
+            self._build_obs_type_info()
         if not is_effort and self.effort_prob_matrix[:, :, 0].sum() != 0:
             raise Exception(
                 "Effort rates are not set to 1 while disabled the update in effort parameter."
             )
 
-        param_chain = {
-            "pi": np.zeros((max_iter, self.Mx - 1)),
-            "c": np.zeros((max_iter, (self.Mx * (self.My - 1)) * self.unique_item_num)),
+        chain_width = {
+            "pi": self.Mx - 1,
+            "c": (self.Mx * (self.My - 1)) * self.unique_item_num,
         }
 
         if is_effort:
-            param_chain["e"] = np.zeros((max_iter, self.Mx * self.J))
+            chain_width["e"] = self.Mx * self.J
+
+        # chain_file: keep the chain in memory maps on disk instead of RAM
+        # a paused segment has no rows in chain_state, they stay in chain_file
+        is_paused = chain_state is not None and "param_chain" not in chain_state
+        param_chain = init_param_chain(
+            max_iter, chain_width, chain_file, "r+" if is_paused else "w+"
+        )
 
         # cache the generated states
         X_mat_dict = {}
         for t in range(1, self.T + 1):
             X_mat_dict[t] = generate_states(t, self.Mx)
 
+        data = self.observ_data
+        is_observ = data["E"] != 0
+        item_param_array = np.array(
+            [self.item_param_dict[j] for j in range(self.J)], dtype=np.int64
+        )
+
+        # pick up a checkpointed chain where it stopped
+        start_iter = 0
         tot_error_cnt = 0
-        for iter in tqdm(range(max_iter)):
+        saved_iter = 0
+        if chain_state is not None:
+            start_iter = chain_state["iter"]
+            tot_error_cnt = chain_state["tot_error_cnt"]
+            if start_iter > max_iter:
+                raise Exception(
+                    "The checkpoint has %d iterations, more than max_iter." % start_iter
+                )
+            if not is_paused:
+                for name, chain in chain_state["param_chain"].items():
+                    param_chain[name][0:start_iter] = chain
+            set_rng_state(self.rng, chain_state["rng"])
+            if chain_state.get("file") == checkpoint_file:
+                # the rows before start_iter are already in the checkpoint
+                saved_iter = start_iter
+
+        # stop_iter: pause the chain early, the rest of the rows stay empty
+        end_iter = max_iter if stop_iter is None else stop_iter
+        for iter in tqdm(range(start_iter, end_iter)):
             if tot_error_cnt > 10:
                 raise Exception("Too many erros in drawing")
 
@@ -130,9 +169,7 @@ class DIRT_MCMC(object):
                 Ts = len(O)
                 X_mat = X_mat_dict[Ts]
 
-                llk_vec = {}
-                pis = {}
-                llk_vec, pis = update_state_parmeters(
+                log_llk_vec, pis = update_state_parmeters(
                     X_mat,
                     self.Mx,
                     O,
@@ -145,16 +182,20 @@ class DIRT_MCMC(object):
                     is_effort,
                 )
 
-                self.obs_type_info[key]["llk_vec"] = llk_vec
+                self.obs_type_info[key]["log_llk_vec"] = log_llk_vec
                 self.obs_type_info[key]["pi"] = pis
 
             # sample states backwards
-            X = np.zeros((self.T, self.K), dtype=np.int)
-            for i in range(self.K):
-                obs_key = self.obs_type_ref[i]
-                # sample the state
-                pi = self.obs_type_info[obs_key]["pi"]
-                X[:, i] = random_choice(pi)
+            # draw the state of all learners at once
+            type_pi = np.array(
+                [
+                    self.obs_type_info[key]["pi"]
+                    for key in range(len(self.obs_type_info))
+                ]
+            )
+            X = random_choice_batch(type_pi[self.obs_type_ref], self.rng)
+            # the state of the learner at each of the observation
+            X_obs = X[data.seq_index]
 
             #############################
             # Step 2: Update Parameter  #
@@ -162,21 +203,20 @@ class DIRT_MCMC(object):
             # try:
             # upate pi | Type 0 and 1 are low mastery, Type 2 are high mastery
             pi_params = [
-                self.prior_param["pi"][x] + np.sum(X[0, :] == x) for x in range(self.Mx)
+                self.prior_param["pi"][x] + np.sum(X == x) for x in range(self.Mx)
             ]
             new_state_init_dist = np.zeros((1, self.Mx))
-            new_state_init_dist = np.random.dirichlet(pi_params)
+            new_state_init_dist = self.rng.dirichlet(pi_params)
 
             # update c
-            obs_cnt = np.zeros((self.unique_item_num, self.Mx, self.My))  # state,observ
-            for k in range(self.K):
-                for t in range(0, self.T_vec[k]):
-                    o_j = self.J_array[t, k]
-                    o_is_e = self.E_array[t, k]
-                    if o_is_e:
-                        obs_cnt[
-                            self.item_param_dict[o_j], X[t, k], self.O_array[t, k]
-                        ] += 1
+            obs_cnt = count_cell(
+                (self.unique_item_num, self.Mx, self.My),
+                (
+                    item_param_array[data["J"][is_observ]],
+                    X_obs[is_observ],
+                    data["O"][is_observ],
+                ),
+            )  # state,observ
 
             new_observ_prob_matrix = np.zeros((self.J, self.Mx, self.My))
             for item_id in range(self.unique_item_num):
@@ -188,7 +228,7 @@ class DIRT_MCMC(object):
                     for x in range(self.Mx)
                 ]
                 try:
-                    c_draws = draw_c(c_params, self.Mx, self.My)
+                    c_draws = draw_c(c_params, self.Mx, self.My, rng=self.rng)
                 except Exception as Err:
                     if is_robust:
                         # TODO: Find a better solution than assign the old value
@@ -202,27 +242,21 @@ class DIRT_MCMC(object):
 
             # update e
             if is_effort:
-                effort_cnt = np.zeros((self.J, self.Mx), dtype=np.int)
-                effort_state_cnt = np.zeros((self.J, self.Mx), dtype=np.int)
-                for k in range(self.K):
-                    for t in range(0, self.T_vec[k]):
-                        o_j = self.J_array[t, k]
-                        o_is_e = self.E_array[t, k]
-
-                        effort_cnt[o_j, X[t, k]] += o_is_e
-                        effort_state_cnt[o_j, X[t, k]] += 1
-                for j in range(self.J):
-                    self.effort_prob_matrix[j] = [
-                        np.random.dirichlet(
-                            (
-                                self.prior_param["e"][0]
-                                + effort_state_cnt[j, x]
-                                - effort_cnt[j, x],
-                                self.prior_param["e"][1] + effort_cnt[j, x],
-                            )
-                        )
-                        for x in range(self.Mx)
-                    ]
+                effort_idx = (data["J"], X_obs)
+                effort_cnt = count_cell(
+                    (self.J, self.Mx), effort_idx, weights=data["E"]
+                ).astype(np.int64)
+                effort_state_cnt = count_cell((self.J, self.Mx), effort_idx).astype(
+                    np.int64
+                )
+                # a two state dirichlet is a beta, drawn for all cells at once
+                effort_rate = self.rng.beta(
+                    self.prior_param["e"][1] + effort_cnt,
+                    self.prior_param["e"][0] + effort_state_cnt - effort_cnt,
+                )
+                self.effort_prob_matrix = np.stack(
+                    [1 - effort_rate, effort_rate], axis=2
+                )
             """
             except AttributeError as e:
                 tot_error_cnt += 1
@@ -251,10 +285,21 @@ class DIRT_MCMC(object):
             if is_effort:
                 param_chain["e"][iter, :] = self.effort_prob_matrix[:, :, 1].flatten()
 
+            if checkpoint_file and (
+                (iter + 1) % checkpoint_every == 0 or iter + 1 == end_iter
+            ):
+                save_checkpoint(
+                    checkpoint_file,
+                    self._get_chain_state(iter + 1, param_chain, tot_error_cnt),
+                    param_chain,
+                    saved_iter,
+                )
+                saved_iter = iter + 1
+
         """
         END of MCMC LOOP
         """
-
+        self.tot_error_cnt = tot_error_cnt
         return param_chain
 
     def _get_initial_param(
@@ -300,46 +345,24 @@ class DIRT_MCMC(object):
                         m, n = pos
                         self.prior_param["c"][m][n] = 0
 
-            self.state_init_dist = np.random.dirichlet(
+            self.state_init_dist = self.rng.dirichlet(
                 self.prior_param["pi"]
             )  # wrap a list to allow for 1 mixture
             self.observ_prob_matrix = np.array(
                 [
-                    draw_c(self.prior_param["c"], self.Mx, self.My)
+                    draw_c(self.prior_param["c"], self.Mx, self.My, rng=self.rng)
                     for j in range(self.unique_item_num)
                 ]
             )
 
             if is_effort:
-                self.effort_prob_matrix = np.array(
-                    [
-                        [
-                            np.random.dirichlet(self.prior_param["e"])
-                            for x in range(self.Mx)
-                        ]
-                        for j in range(self.J)
-                    ]
+                self.effort_prob_matrix = self.rng.dirichlet(
+                    self.prior_param["e"], size=(self.J, self.Mx)
                 )
             else:
                 self.effort_prob_matrix = np.zeros((self.J, self.Mx, 2))
                 self.effort_prob_matrix[:, :, 1] = 1.0
 
-    def _work(
-        self,
-        max_iter,
-        is_effort,
-        is_robust,
-        init_param,
-        prior_dist,
-        zero_mass_set,
-        item_param_constraint,
-    ):
-        self._get_initial_param(
-            init_param, prior_dist, zero_mass_set, item_param_constraint, is_effort
-        )
-        param_chain = self._MCMC(max_iter, is_effort, is_robust)
-        return param_chain
-
     def estimate(
         self,
         data_array,
@@ -354,8 +377,17 @@ class DIRT_MCMC(object):
         is_effort=False,
         is_parallel=False,
         is_robust=False,
+        checkpoint_path=None,
+        checkpoint_every=100,
+        resume_from=None,
+        chain_dir=None,
+        is_early_stop=False,
+        diagnose_every=100,
+        rhat_tol=1.01,
+        min_ess=400,
+        seed=None,
     ):
-        # data = [i,j,y(,e)]
+        # data = [i,j,y(,e)], or the columns i, j, y(, e) as arrays
         # i: learner id from 0:N-1
         # j: item id, from 0:J-1
         # y: response, 0 or 1
@@ -376,7 +408,9 @@ class DIRT_MCMC(object):
                     data_array, invalid_item_ids=invalid_items
                 )
             else:
-                raise Exception("Invalid items are :\n" + "\n".join(invalid_items))
+                raise Exception(
+                    "Invalid items are :\n" + "\n".join(map(str, invalid_items))
+                )
         else:
             self.item_dict, data = data_etl(data_array)
 
@@ -394,37 +428,26 @@ class DIRT_MCMC(object):
 
         self._collapse_obser_state()
 
-        # run MCMC
-        if not is_parallel:
-            param_chain_vec = []
-            for iChain in range(chain_num):
-                self._get_initial_param(
-                    init_param,
-                    prior_dist,
-                    zero_mass_set,
-                    item_param_constraint,
-                    is_effort,
-                )
-                tmp_param_chain = self._MCMC(max_iter, is_effort, is_robust)
-                param_chain_vec.append(tmp_param_chain)
-        else:
-            param_chain_vec = Parallel(n_jobs=chain_num)(
-                delayed(self._work)(
-                    max_iter,
-                    is_effort,
-                    is_robust,
-                    init_param,
-                    prior_dist,
-                    zero_mass_set,
-                    item_param_constraint,
-                )
-                for i in range(chain_num)
-            )
+        param_chain_vec, num_iter, burn_in = self._run_chains(
+            max_iter,
+            (init_param, prior_dist, zero_mass_set, item_param_constraint, is_effort),
+            (is_effort, is_robust),
+            chain_num,
+            is_parallel,
+            checkpoint_path,
+            checkpoint_every,
+            resume_from,
+            chain_dir,
+            is_early_stop,
+            diagnose_every,
+            rhat_tol,
+            min_ess,
+            seed,
+        )
 
         # update obj
-        burn_in = min(300, int(max_iter / 2))
         self.param_chain = get_final_chain(
-            param_chain_vec, burn_in, max_iter, is_effort
+            param_chain_vec, burn_in, num_iter, is_effort
         )
 
     def get_item_param(self):
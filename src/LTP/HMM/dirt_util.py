@@ -2,6 +2,10 @@ from collections import defaultdict
 
 import numpy as np
 
+from .util import safe_log, logExpSum
+from .data_util import get_log_columns
+
+
 def generate_states(T, max_level):
     states = np.zeros((max_level, T), dtype=int)
     for x in range(max_level):
@@ -9,18 +13,7 @@ def generate_states(T, max_level):
     return states
 
 
-def state_llk(X, J, E, init_dist, transit_matrix):
-    # X: vector of latent state, list
-    # transit matrix is np array [t-1,t]
-    # if X[0] == 1:
-    prob = init_dist[X[0]] * np.product(
-        [transit_matrix[J[t - 1], E[t - 1], X[t - 1], X[t]] for t in range(1, len(X))]
-    )
-
-    return prob
-
-
-def likelihood(
+def log_likelihood(
     X_val,
     O,
     E,
@@ -38,31 +31,32 @@ def likelihood(
     T = len(O)
 
     # P(O|X)
-    po = 1
-    pe = 1
+    po = 0.0
+    pe = 0.0
     # P(E|X)
     if is_effort:
         # The effort is generated base on the initial X.
         for t in range(T):
-            pe *= effort_prob_matrix[J[t], X_val, E[t]]
+            pe += safe_log(effort_prob_matrix[J[t], X_val, E[t]])
 
         for t in range(T):
             if E[t] != 0:
-                po *= observ_prob_matrix[item_ids[t], X_val, O[t]]
+                po += safe_log(observ_prob_matrix[item_ids[t], X_val, O[t]])
             else:
-                po *= 1.0 if O[t] == 0 else 0.0  # this is a strong built in restriction
+                # this is a strong built in restriction
+                po += 0.0 if O[t] == 0 else -np.inf
     else:
         for t in range(T):
-            po *= observ_prob_matrix[item_ids[t], X_val, O[t]]
+            po += safe_log(observ_prob_matrix[item_ids[t], X_val, O[t]])
 
     # P(X)
-    px = state_init_dist[X_val]
-    lk = po * px * pe
+    px = safe_log(state_init_dist[X_val])
+    llk = po + px + pe
 
-    if lk < 0:
-        raise ValueError("Negative likelihood.")
+    if np.isnan(llk):
+        raise ValueError("Invalid likelihood.")
 
-    return lk
+    return llk
 
 
 def get_llk_all_states(
@@ -76,11 +70,12 @@ def get_llk_all_states(
     effort_prob_matrix,
     is_effort,
 ):
+    # log likelihood of each state
     N_X = X_mat.shape[0]
     llk_vec = []
     for i in range(N_X):
         llk_vec.append(
-            likelihood(
+            log_likelihood(
                 X_mat[i, 0],
                 O,
                 E,
@@ -115,7 +110,7 @@ def update_state_parmeters(
 ):
     # calculate the exhaustive state probablity
     Ti = len(O)
-    llk_vec = get_llk_all_states(
+    log_llk_vec = get_llk_all_states(
         X_mat,
         O,
         E,
@@ -127,16 +122,17 @@ def update_state_parmeters(
         is_effort,
     )
 
-    if abs(llk_vec.sum()) < 1e-40:
+    tot_log_llk = logExpSum(log_llk_vec)
+    if tot_log_llk == -np.inf:
         raise ValueError("All likelihood are 0.")
 
+    # normalize in the log space, llk_vec is the posterior of the states
+    llk_vec = np.exp(log_llk_vec - tot_log_llk)
+
     # pi
-    tot_llk = llk_vec.sum()
-    pis = [
-        get_single_state_llk(X_mat, llk_vec, Ti - 1, x) / tot_llk for x in range(Mx)
-    ]  # equal to draw one
+    pis = [get_single_state_llk(X_mat, llk_vec, Ti - 1, x) for x in range(Mx)]
 
-    return llk_vec, pis
+    return log_llk_vec, pis
 
 
 def data_etl(data_array, invalid_item_ids=[]):
@@ -147,7 +143,12 @@ def data_etl(data_array, invalid_item_ids=[]):
     (1) user_dict: map input user id to consecutive int
     (2) item_dict: map input item id to consecutive int
     (3) data: [i,t,j,y(,e)] Add a t to indicate sequence length
+
+    Column arrays (e.g. from load_log_columns) are remapped with array
+    operations and return the columns i, t, j, y, e.
     """
+    if not isinstance(data_array, list):
+        return _column_etl(data_array, invalid_item_ids)
 
     user_reverse_dict = {}
     item_reverse_dict = {}
@@ -202,6 +203,9 @@ def data_etl(data_array, invalid_item_ids=[]):
 
 def filter_invalid_items(data_array):
     # check if any of the item has pure right or pure wrong
+    if not isinstance(data_array, list):
+        return _filter_invalid_item_columns(data_array)
+
     item_all_cnt = defaultdict(int)
     item_right_cnt = defaultdict(int)
 
@@ -229,10 +233,56 @@ def filter_invalid_items(data_array):
     return invalid_items
 
 
+def _get_appearance_code(values):
+    # map the values to 0:N-1 in the order of their first appearance
+    uniq_values, first_idx, inverse = np.unique(
+        values, return_index=True, return_inverse=True
+    )
+    order = np.argsort(first_idx)
+    codes = np.empty(len(uniq_values), dtype=np.int64)
+    codes[order] = np.arange(len(uniq_values))
+    return uniq_values[order], codes[inverse]
+
+
+def _column_etl(data_array, invalid_item_ids):
+    logs = get_log_columns(data_array, ["i", "j", "y", "e"], {"e": 1})
+    is_valid = ~np.isin(logs["j"], invalid_item_ids)
+    logs = {name: np.asarray(col)[is_valid] for name, col in logs.items()}
+
+    _, learner_ids = _get_appearance_code(logs["i"])
+    item_ids, item_id_vals = _get_appearance_code(logs["j"])
+    item_dict = dict(enumerate(item_ids.tolist()))
+
+    # t is the order of the log within the learner
+    order = np.argsort(learner_ids, kind="stable")
+    learner_cnt = np.bincount(learner_ids)
+    learner_start = np.cumsum(learner_cnt) - learner_cnt
+    t = np.arange(len(order)) - np.repeat(learner_start, learner_cnt)
+
+    data = {
+        "i": learner_ids[order],
+        "t": t,
+        "j": item_id_vals[order],
+        "y": logs["y"][order],
+        "e": logs["e"][order],
+    }
+    return item_dict, data
+
+
+def _filter_invalid_item_columns(data_array):
+    logs = get_log_columns(data_array, ["i", "j", "y", "e"], {"e": 1})
+    item_ids, item_idx = np.unique(logs["j"], return_inverse=True)
+    item_all_cnt = np.bincount(item_idx)
+    item_right_cnt = np.bincount(item_idx, weights=logs["y"])
+    accuracy = item_right_cnt / item_all_cnt
+    return item_ids[(accuracy <= 0.01) | (accuracy >= 0.99)].tolist()
+
+
 def get_final_chain(param_chain_vec, start, end, is_effort):
     # calcualte the llk for the parameters
     gap = max(int((end - start) / 100), 10)
-    select_idx = range(start, end, gap)
+    # a strided slice only touches the kept rows of a disk backed chain
+    select_idx = slice(start, end, gap)
     num_chain = len(param_chain_vec)
 
     # get rid of burn in
@@ -287,5 +337,5 @@ if __name__ == "__main__":
         effort_prob_matrix,
         False,
     )
-    print(llk_vec)
+    print(np.exp(llk_vec))
     print(0.6 * 0.8 * 0.2, 0.4 * 0.1 * 0.9)
@@ -1,42 +1,58 @@
 import numpy as np
 from tqdm import tqdm
+from joblib import Parallel, delayed
 
 from collections import defaultdict
 import copy
 
+from .util import update_mastery, compute_success_rate
+from .data_util import RaggedSeq, get_ragged_pattern_index, get_log_columns
+
 # use EM to compute the bayes net
 class BKT_HMM_EM(object):
     def _load_observ(self, data):
         # data = [(i,t,j,y,e)] where i is the spell sequence id from 0:N-1, t starts from 0
 
-        self.K = len(set([x[0] for x in data]))
-        self.T = max([x[1] for x in data]) + 1
+        # the columns after y, e.g. (h,e) of the MCMC logs, are not used by the EM
+        logs = get_log_columns(data, ["i", "t", "j", "y"], is_strict=False)
+
+        # the responses of each learner are stored back to back, without padding
+        self.observ_data = RaggedSeq.from_logs(
+            logs["i"],
+            logs["t"],
+            {"O": logs["y"]},
+            {"O": np.int8},
+        )
+        self.K = self.observ_data.num_seq
+        self.T = self.observ_data.max_len
 
-        self.observ_data = np.empty((self.T, self.K))
-        T_array = np.zeros((self.K,))
+        # initialize
+        self._update_derivative_parameter()  # learning spead
 
-        for log in data:
-            i = log[0]
-            t = log[1]
-            y = log[3]
-            self.observ_data[t, i] = y
-            T_array[i] = t
+    def _collapse_obser_state(self):
+        # learners with identical response sequence share the E step
+        patterns, _, self.obs_type_cnt, self.obs_type_ref = get_ragged_pattern_index(
+            self.observ_data, ["O"]
+        )
+        # the E step runs on the padded T*N responses of the unique sequences
+        self.obs_type_num = patterns.num_seq
+        self.obs_type_T_vec = patterns.lengths
+        self.obs_type_mask = np.arange(self.T)[:, None] < self.obs_type_T_vec[None, :]
+        self.obs_type_data = patterns.to_dense("O").astype(int)
 
-        self.T_vec = [int(x) + 1 for x in T_array.tolist()]
-        self.T = max(self.T_vec)
+        self._init_forward_backward(self.obs_type_num)
 
+    def _init_forward_backward(self, N):
         # initilize for the rest of the structure
-        st_size = (self.T, self.K, 2)
+        st_size = (self.T, N, 2)
         self.a_vec = np.zeros(st_size)
         self.b_vec = np.zeros(st_size)
 
         self.r_vec = np.zeros(st_size)
-        self.eta_vec = np.zeros((self.T, self.K, 2, 2))
+        self.eta_vec = np.zeros((self.T, N, 2, 2))
         self.r_vec_uncond = np.zeros(st_size)
-        self.eta_vec_uncond = np.zeros((self.T, self.K, 2, 2))
-
-        # initialize
-        self._update_derivative_parameter()  # learning spead
+        self.eta_vec_uncond = np.zeros((self.T, N, 2, 2))
+        self.c_vec = np.ones((self.T, N))
 
     def _update_derivative_parameter(self):
         self.state_transit_matrix = np.array([[1 - self.l, self.l], [0, 1]])
@@ -45,190 +61,264 @@ class BKT_HMM_EM(object):
             [[1 - self.g, self.g], [self.s, 1 - self.s]]
         )  # index by state, observ
 
-    def _update_forward(self, t, k, state):
-        observ = int(self.observ_data[t, k])
-        if t == 0:
-            self.a_vec[t, k, state] = (
-                self.state_init_dist[state] * self.observ_prob_matrix[state, observ]
-            )
+    def _update_forward_batch(self, is_scaled):
+        # advance all K sequences along t at once
+        # in the scaled mode, a(t) is normalized to P(X_t|O_1,...,O_t) and the
+        # normalizer c(t)=P(O_t|O_1,...,O_{t-1}) is kept to rescale b and eta
+        for t in range(self.T):
+            if t == 0:
+                self.a_vec[t] = self.state_init_dist * self.emit_prob[t]
+            else:
+                self.a_vec[t] = (
+                    np.dot(self.a_vec[t - 1], self.state_transit_matrix)
+                    * self.emit_prob[t]
+                )
+            self.a_vec[t] *= self.obs_type_mask[t][:, None]
+            if is_scaled:
+                self.c_vec[t] = np.where(
+                    self.obs_type_mask[t], self.a_vec[t].sum(axis=1), 1.0
+                )
+                self.a_vec[t] /= self.c_vec[t][:, None]
+
+        # log P(O_1,...,O_T) of each sequence
+        if is_scaled:
+            self.obs_llk = np.log(self.c_vec).sum(axis=0)
         else:
-            self.a_vec[t, k, state] = (
-                np.dot(self.a_vec[t - 1, k, :], self.state_transit_matrix[:, state])
-                * self.observ_prob_matrix[state, observ]
+            self.obs_llk = np.log(
+                self.a_vec[
+                    self.obs_type_T_vec - 1, np.arange(self.obs_type_num), :
+                ].sum(axis=1)
             )
 
-    def _update_backward(self, t, k, state):
-        if t == self.T_vec[k] - 1:
-            self.b_vec[t, k, state] = 1
-        else:
-            observ = int(self.observ_data[t + 1, k])
-            if state == 0:
-                self.b_vec[t, k, state] = (
-                    self.state_transit_matrix[0, 1]
-                    * self.observ_prob_matrix[1, observ]
-                    * self.b_vec[t + 1, k, 1]
-                    + self.state_transit_matrix[0, 0]
-                    * self.observ_prob_matrix[0, observ]
-                    * self.b_vec[t + 1, k, 0]
+    def _update_backward_batch(self):
+        for t in range(self.T - 1, -1, -1):
+            is_last = self.obs_type_mask[t]
+            if t != self.T - 1:
+                is_last = is_last & ~self.obs_type_mask[t + 1]
+                self.b_vec[t] = np.dot(
+                    self.emit_prob[t + 1] * self.b_vec[t + 1],
+                    self.state_transit_matrix.T,
                 )
+                if self.is_scaled:
+                    self.b_vec[t] /= self.c_vec[t + 1][:, None]
             else:
-                self.b_vec[t, k, state] = (
-                    self.observ_prob_matrix[state, observ] * self.b_vec[t + 1, k, 1]
-                )
-
-    def _update_eta(self, t, k):
-        observ = int(self.observ_data[t + 1, k])
-        eta_raw = np.zeros((2, 2))
-        eta_raw[0, 0] = (
-            self.a_vec[t, k, 0]
-            * self.state_transit_matrix[0, 0]
-            * self.observ_prob_matrix[0, observ]
-            * self.b_vec[t + 1, k, 0]
-        )
-        eta_raw[0, 1] = (
-            self.a_vec[t, k, 0]
-            * self.state_transit_matrix[0, 1]
-            * self.observ_prob_matrix[1, observ]
-            * self.b_vec[t + 1, k, 1]
+                self.b_vec[t] = 0
+            self.b_vec[t, is_last, :] = 1
+
+    def _update_gamma_batch(self):
+        self.r_vec_uncond = self.a_vec * self.b_vec
+        gamma_sum = self.r_vec_uncond.sum(axis=2, keepdims=True)
+        self.r_vec = np.divide(
+            self.r_vec_uncond,
+            gamma_sum,
+            out=np.zeros_like(self.r_vec_uncond),
+            where=gamma_sum > 0,
         )
-        eta_raw[1, 0] = (
-            self.a_vec[t, k, 1]
-            * self.state_transit_matrix[1, 0]
-            * self.observ_prob_matrix[0, observ]
-            * self.b_vec[t + 1, k, 0]
+
+    def _update_eta_batch(self):
+        # eta(t,k,m,n) = a(t,k,m) * P(m,n) * P(O_{t+1}|n) * b(t+1,k,n)
+        self.eta_vec_uncond[:] = 0
+        self.eta_vec_uncond[:-1] = (
+            self.a_vec[:-1, :, :, None]
+            * self.state_transit_matrix[None, None, :, :]
+            * (self.emit_prob[1:] * self.b_vec[1:])[:, :, None, :]
         )
-        eta_raw[1, 1] = (
-            self.a_vec[t, k, 1]
-            * self.state_transit_matrix[1, 1]
-            * self.observ_prob_matrix[1, observ]
-            * self.b_vec[t + 1, k, 1]
+        if self.is_scaled:
+            self.eta_vec_uncond[:-1] /= self.c_vec[1:, :, None, None]
+        eta_sum = self.eta_vec_uncond.sum(axis=(2, 3), keepdims=True)
+        self.eta_vec = np.divide(
+            self.eta_vec_uncond,
+            eta_sum,
+            out=np.zeros_like(self.eta_vec_uncond),
+            where=eta_sum > 0,
         )
-        eta = eta_raw / eta_raw.sum()
-        return eta, eta_raw
 
-    def _update_gamma(self, t, k):
-        gamma_raw = np.zeros((2,))
-        gamma_raw[0] = self.a_vec[t, k, 0] * self.b_vec[t, k, 0]
-        gamma_raw[1] = self.a_vec[t, k, 1] * self.b_vec[t, k, 1]
-        gamma = gamma_raw / gamma_raw.sum()
-        return gamma, gamma_raw
-
-    def estimate(self, init_param, data, max_iter=10, print_on=False):
+    def _set_param(self, param):
+        # accept both the scalar output of get_param and the list style input
+        self.g = float(np.ravel(param["g"])[0])  # guess
+        self.s = float(np.ravel(param["s"])[0])  # slippage
+        self.pi = float(np.ravel(param["pi"])[0])  # initial prob of mastery
+        self.l = float(np.ravel(param["l"])[0])  # learn speed
+
+    def get_param(self):
+        return {"s": self.s, "g": self.g, "pi": self.pi, "l": self.l}
+
+    def estimate(
+        self,
+        init_param,
+        data,
+        max_iter=10,
+        print_on=False,
+        is_scaled=False,
+        tol=None,
+        warm_start=False,
+    ):
+        # is_scaled: normalize the forward-backward factors at each step, which
+        # is required for long spells where the raw probabilities underflow
+        # tol: stop when the relative change of the log likelihood is below tol
+        # warm_start: start from the parameters of the previous fit, if any.
+        #   init_param also accepts the output of get_param of a previous fit.
+        self.is_scaled = is_scaled
+        if warm_start and hasattr(self, "l"):
+            init_param = self.get_param()
         param = copy.deepcopy(init_param)
-        self.g = param["g"][0]  # guess
-        self.s = param["s"][0]  # slippage
-        self.pi = param["pi"]  # initial prob of mastery
-        self.l = param["l"][0]  # learn speed
+        self._set_param(param)
 
         self._load_observ(data)
+        self._collapse_obser_state()
 
-        # TODO: better convergence property
+        self.llk_trajectory = []
+        self.is_converged = False
+        self.iteration_num = 0
         for i in tqdm(range(max_iter)):
             self._em_update()
+            self.iteration_num += 1
+            # log likelihood of the parameters before the update
+            llk = np.dot(self.obs_llk, self.obs_type_cnt)
+            self.llk_trajectory.append(llk)
             if print_on:
-                print(self.s, self.g, self.pi, self.l)
+                print(self.s, self.g, self.pi, self.l, llk)
+
+            if tol is not None and len(self.llk_trajectory) > 1:
+                llk_prev = self.llk_trajectory[-2]
+                if abs(llk - llk_prev) <= tol * abs(llk_prev):
+                    self.is_converged = True
+                    break
 
         return self.s, self.g, self.pi, self.l
 
-    def _em_update(self):
+    @staticmethod
+    def estimate_many(
+        init_param,
+        data_by_skill,
+        max_iter=10,
+        is_scaled=False,
+        tol=None,
+        n_jobs=1,
+    ):
+        # data_by_skill: {skill: [(i,t,j,y(,e))]} or column arrays per skill,
+        # one BKT model per skill
+        # The skills are fitted in n_jobs worker processes. Each worker only
+        # receives the int columns of its skill.
+        skills = list(data_by_skill.keys())
+        res_list = Parallel(n_jobs=n_jobs)(
+            delayed(_estimate_skill)(
+                init_param,
+                _get_skill_data(data_by_skill[skill]),
+                max_iter,
+                is_scaled,
+                tol,
+            )
+            for skill in skills
+        )
+        # {skill: (s, g, pi, l)}
+        return dict(zip(skills, res_list))
 
-        # TODO: collapse states to speed up calculations
-        for k in range(self.K):
-            # update forward
-            for t in range(self.T_vec[k]):
-                self._update_forward(t, k, 0)
-                self._update_forward(t, k, 1)
-
-            # update backward
-            for t in range(self.T_vec[k] - 1, -1, -1):
-                self._update_backward(t, k, 0)
-                self._update_backward(t, k, 1)
-
-            # compute r
-            for t in range(self.T_vec[k]):
-                self.r_vec[t, k, :], self.r_vec_uncond[t, k, :] = self._update_gamma(
-                    t, k
-                )
+    def _em_update(self):
 
-            # compute eta
-            for t in range(self.T_vec[k] - 1):
-                (
-                    self.eta_vec[t, k, :, :],
-                    self.eta_vec_uncond[t, k, :, :],
-                ) = self._update_eta(t, k)
+        # P(O_t|X_t), T*N*2, N is the number of unique response sequences
+        self.emit_prob = self.observ_prob_matrix.T[self.obs_type_data]
+        self._update_forward_batch(self.is_scaled)
+        self._update_backward_batch()
+        self._update_gamma_batch()
+        self._update_eta_batch()
 
         # update parameters
-        # obs_weight = np.ones((self.K,))
-        obs_prob = np.empty((self.K,))
-        for k in range(self.K):
-            obs_prob[k] = self.a_vec[self.T_vec[k] - 1, k, :].sum()
-        obs_weight = 1 / obs_prob
-
-        self.pi = self.r_vec[0, :, 1].mean()
-
-        nominator = 0
-        denominator = 0
-        for k in range(self.K):
-            nominator += (
-                self.eta_vec_uncond[0 : self.T_vec[k] - 1, k, 0, 1].sum()
-                * obs_weight[k]
-            )
-            denominator += (
-                self.r_vec_uncond[0 : self.T_vec[k] - 1, k, 0].sum() * obs_weight[k]
-            )
+        # the posteriors are conditional on the observations, so each sequence
+        # is weighted by the number of learners sharing it
+        obs_weight = self.obs_type_cnt
+
+        self.pi = np.dot(self.r_vec[0, :, 1], obs_weight) / self.K
 
+        # the transition at t only counts if t+1 is observed
+        nominator = np.dot(self.eta_vec[:, :, 0, 1].sum(axis=0), obs_weight)
+        denominator = np.dot(
+            (self.r_vec[:-1, :, 0] * self.obs_type_mask[1:]).sum(axis=0), obs_weight
+        )
         self.l = nominator / denominator
 
-        # self.l = np.dot(self.eta_vec_uncond[:,:,0,1].sum(axis=0), obs_weight) / np.dot(self.r_vec_uncond[:,:,0].sum(axis=0), obs_weight)
         # need to count the right and wrong
-        self.tmp = np.zeros((self.T, self.K, 2))
-        for k in range(self.K):
-            for t in range(self.T_vec[k]):
-                observ = int(self.observ_data[t, k])
-                self.tmp[t, k, observ] = self.r_vec_uncond[t, k, 1 - observ]
-        self.s = np.dot(self.tmp[:, :, 0].sum(axis=0), obs_weight) / np.dot(
-            self.r_vec_uncond[:, :, 1].sum(axis=0), obs_weight
+        is_right = self.obs_type_data == 1
+        self.s = np.dot(
+            (self.r_vec[:, :, 1] * ~is_right * self.obs_type_mask).sum(axis=0),
+            obs_weight,
+        ) / np.dot(
+            self.r_vec[:, :, 1].sum(axis=0), obs_weight
         )  # observe 0 when state is 1
 
-        self.g = np.dot(self.tmp[:, :, 1].sum(axis=0), obs_weight) / np.dot(
-            self.r_vec_uncond[:, :, 0].sum(axis=0), obs_weight
+        self.g = np.dot(
+            (self.r_vec[:, :, 0] * is_right * self.obs_type_mask).sum(axis=0),
+            obs_weight,
+        ) / np.dot(
+            self.r_vec[:, :, 0].sum(axis=0), obs_weight
         )  # observe 1 when state is 0
 
         # update the derivatives
         self._update_derivative_parameter()
 
-    def predict(self, param, data):
-        # this does not predict single state
-        self.g = param["g"]  # guess
-        self.s = param["s"]  # slippage
-        self.pi = param["pi"]  # initial prob of mastery
-        self.l = param["l"]  # learn speed
+    def predict_array(self, param, data, return_mastery=False):
+        # yHat[t,k] = P(Y_t=1|Y_0,...,Y_{t-1}) for every learner k, T*K
+        # mastery[t,k] = P(X_t=1|Y_0,...,Y_t), the filtered posterior
+        # cells after the end of the spell are nan
+        self._set_param(param)
 
         if self.pi == 0 or self.l == 0:
             raise ValueError("Invalid Prior.")
 
         self._load_observ(data)
+        self._collapse_obser_state()
+
+        # the filtered posterior only needs the scaled forward factor
+        self.emit_prob = self.observ_prob_matrix.T[self.obs_type_data]
+        self._update_forward_batch(True)
+        mastery = self.a_vec[:, :, 1][:, self.obs_type_ref]
+
+        # the mastery before the response at t
+        prior_mastery = np.empty((self.T, self.K))
+        prior_mastery[0] = self.pi
+        prior_mastery[1:] = update_mastery(mastery[:-1], self.l)
+        yHat = compute_success_rate(self.s, self.g, prior_mastery)
+
+        # mask out the periods after the spell ends
+        observ_mask = np.arange(self.T)[:, None] < self.observ_data.lengths[None, :]
+        yHat[~observ_mask] = np.nan
+        mastery[~observ_mask] = np.nan
+        if return_mastery:
+            return yHat, mastery
+        else:
+            return yHat
 
-        # calculate the forward factor
-        for k in range(self.K):
-            # update forward
-            for t in range(self.T_vec[k]):
-                self._update_forward(t, k, 0)
-                self._update_forward(t, k, 1)
-
-        # calculate the posterior state distribution
-        output = []
-        for k in range(self.K):
-            for t in range(self.T_vec[k] - 1):
-                x_t_posterior = self.a_vec[t, k, 1] / self.a_vec[t, k, :].sum()
-                pyHat = ((1 - x_t_posterior) * self.l + x_t_posterior) * (
-                    1 - self.s
-                ) + (1 - x_t_posterior) * (1 - self.l) * self.g
-                y_true = self.observ_data[t + 1, k]
-                output.append((pyHat, y_true))
+    def predict(self, param, data):
+        # this does not predict single state
+        yHat = self.predict_array(param, data)
+
+        # ordered by learner, then by t
+        is_valid = self.observ_data.t_index > 0
+        output = list(
+            zip(
+                yHat[
+                    self.observ_data.t_index[is_valid],
+                    self.observ_data.seq_index[is_valid],
+                ].tolist(),
+                self.observ_data["O"][is_valid].tolist(),
+            )
+        )
         return output
 
 
+def _get_skill_data(data):
+    # a skill only sees part of the learners, renumber them from 0:N-1
+    logs = get_log_columns(data, ["i", "t", "j", "y"], is_strict=False)
+    _, learner_ids = np.unique(logs["i"], return_inverse=True)
+    return {"i": learner_ids, "t": logs["t"], "j": logs["j"], "y": logs["y"]}
+
+
+def _estimate_skill(init_param, data, max_iter, is_scaled, tol):
+    return BKT_HMM_EM().estimate(
+        init_param, data, max_iter=max_iter, is_scaled=is_scaled, tol=tol
+    )
+
+
 if __name__ == "__main__":
 
     # unit test array
@@ -0,0 +1,160 @@
+import numpy as np
+
+from .util import safe_log
+
+
+def get_emission_prob(
+    Mx,
+    O,
+    E,
+    H,
+    J,
+    item_ids,
+    hazard_matrix,
+    observ_prob_matrix,
+    effort_prob_matrix,
+    is_effort,
+    is_exit,
+    hazard_state,
+):
+    # P(O_t,E_t,H_t|X_t), T*Mx
+    # O: observation
+    # H: binary indicator, whether the spell is ended
+    # E: binary indicator, whether effort is exerted
+    T = len(O)
+    O = np.array(O, dtype=int)
+    E = np.array(E, dtype=int)
+    J = np.array(J, dtype=int)
+    item_ids = np.array(item_ids, dtype=int)
+
+    # P(O|X)
+    po = observ_prob_matrix[item_ids, :, O]
+    if is_effort:
+        # The effort is generated base on the initial X.
+        pe = effort_prob_matrix[J, :, E]
+        # no effort implies a zero response, a strong built in restriction
+        po = np.where(E[:, None] != 0, po, (O[:, None] == 0).astype(float))
+        emit = po * pe
+    else:
+        emit = po
+
+    # P(H|X)
+    if is_exit:
+        if hazard_state == "X":
+            h = hazard_matrix[:, 0:T].T
+        elif hazard_state == "Y":
+            h = np.tile(hazard_matrix[O, np.arange(T)][:, None], (1, Mx))
+        else:
+            raise Exception("Unknown dependent states! %s " % hazard_state)
+        # has survived T-1 period
+        ph = 1 - h
+        ph[T - 1] = H * h[T - 1] + (1 - H) * (1 - h[T - 1])
+        emit = emit * ph
+
+    return emit
+
+
+def forward_filtering(
+    Mx,
+    O,
+    E,
+    H,
+    J,
+    item_ids,
+    hazard_matrix,
+    observ_prob_matrix,
+    state_init_dist,
+    state_transit_matrix,
+    effort_prob_matrix,
+    is_effort,
+    is_exit,
+    hazard_state,
+):
+    # Forward filter in O(T*Mx^2), with per step normalizer to avoid underflow
+    # Output has the same meaning as bfs_util.update_state_parmeters
+    # log_llk_vec: log P(O,X_T=x), its log-sum-exp is the log likelihood
+    # pis: P(X_T=x|O)
+    # l_mat: P(X_{t-1}=n|X_t=m,O), T,X_t,X_{t-1}
+    Ti = len(O)
+    if not is_effort:
+        E = [1 for o in O]
+    emit = get_emission_prob(
+        Mx,
+        O,
+        E,
+        H,
+        J,
+        item_ids,
+        hazard_matrix,
+        observ_prob_matrix,
+        effort_prob_matrix,
+        is_effort,
+        is_exit,
+        hazard_state,
+    )
+
+    alpha = np.zeros((Ti, Mx))
+    l_mat = np.zeros((Ti, Mx, Mx))  # T,X_{t+1},X_t
+    log_llk = 0.0
+    for t in range(Ti):
+        if t == 0:
+            a = state_init_dist * emit[t]
+        else:
+            # transition happens at t, item at t-1 takes credit
+            # the latent state is not allowed to regress
+            transit = np.triu(state_transit_matrix[J[t - 1], E[t - 1]])
+            joint = alpha[t - 1][:, None] * transit  # X_{t-1},X_t
+            p_next = joint.sum(axis=0)
+            valid = p_next > 0
+            l_mat[t, valid, :] = (joint[:, valid] / p_next[valid]).T
+            a = p_next * emit[t]
+        c = a.sum()
+        if c <= 0:
+            raise ValueError("All likelihood are 0.")
+        alpha[t] = a / c
+        log_llk += np.log(c)
+
+    pis = alpha[Ti - 1].tolist()
+    log_llk_vec = safe_log(alpha[Ti - 1]) + log_llk
+
+    return log_llk_vec, pis, l_mat
+
+
+if __name__ == "__main__":
+    # check against the exhaustive enumeration
+    from .bfs_util import generate_states, update_state_parmeters
+    from .util import logExpSum
+
+    state_init_dist = np.array([0.6, 0.4])
+    state_transit_matrix = np.array([[[[1, 0], [0, 1]], [[0.7, 0.3], [0, 1]]]])
+    observ_prob_matrix = np.array([[[0.8, 0.2], [0.1, 0.9]]])
+    hazard_matrix = np.array([[0.2, 0.2, 0.3], [0.1, 0.1, 0.2]])
+    effort_prob_matrix = np.array([[[0.3, 0.7], [0.1, 0.9]]])
+
+    O = [0, 0, 1]
+    E = [1, 0, 1]
+    H = 1
+    J = [0, 0, 0]
+    item_ids = [0, 0, 0]
+    X_mat = generate_states(3, 2, 1)
+    for is_effort, is_exit in [(False, False), (True, True)]:
+        args = (
+            O,
+            E,
+            H,
+            J,
+            item_ids,
+            hazard_matrix,
+            observ_prob_matrix,
+            state_init_dist,
+            state_transit_matrix,
+            effort_prob_matrix,
+            is_effort,
+            is_exit,
+            "X",
+        )
+        llk_bfs, pis_bfs, l_mat_bfs = update_state_parmeters(X_mat, 2, *args)
+        llk_ffbs, pis_ffbs, l_mat_ffbs = forward_filtering(2, *args)
+        print(logExpSum(llk_bfs), logExpSum(llk_ffbs))
+        print(pis_bfs, pis_ffbs)
+        print(np.abs(l_mat_bfs - l_mat_ffbs).max())
@@ -2,26 +2,20 @@
 import numpy as np
 
 from .prop_hazard_ars import ars_sampler
+from .util import count_cell
 
 
-def prop_hazard(M, T_vec, S, H, Lambdas, betas):
+def prop_hazard(M, t_idx, S, H, Lambdas, betas, rng=np.random):
+    # t_idx, S, H: the period, the state and the spell end of each observation
 
-    prop_hazard_mdls = [ars_sampler(Lambdas[i], [betas[i]]) for i in range(M)]
-
-    K = len(T_vec)
+    prop_hazard_mdls = [ars_sampler(Lambdas[i], [betas[i]], rng) for i in range(M)]
 
     # generate S,D
-    hS = [[] for x in range(M)]
-    hD = [[] for x in range(M)]
+    hS = [t_idx[S == m].astype(np.int64).reshape(-1, 1) for m in range(M)]
+    hD = [H[S == m].astype(np.int64) for m in range(M)]
     hIdx = [[] for x in range(M)]
 
-    T = max(T_vec)
-
-    for k in range(K):
-        for t in range(T_vec[k]):
-            m = S[t, k]
-            hS[m].append([t])
-            hD[m].append(H[t, k])
+    T = int(np.max(t_idx)) + 1
 
     # do a stratified sampling by t
     # TODO: Clean up the notation here
@@ -31,12 +25,8 @@ def prop_hazard(M, T_vec, S, H, Lambdas, betas):
         if N == 0:
             continue
         # check how many observations in each sequence length
-        nT = np.zeros((T, 1), dtype=np.int)
-        idxT = [[] for t in range(T)]
-        for i in range(N):
-            t = hS[m][i][0]
-            nT[t] += 1
-            idxT[t].append(i)
+        nT = np.bincount(hS[m][:, 0], minlength=T)
+        idxT = np.split(np.argsort(hS[m][:, 0], kind="stable"), np.cumsum(nT)[:-1])
 
         # TODO:Need to preserve the relative size
         # The current sampling scheme distorts!
@@ -44,7 +34,7 @@ def prop_hazard(M, T_vec, S, H, Lambdas, betas):
             sample_size = min(round(5000 / T), nT[t])
             if sample_size == 0:
                 continue
-            idxs = np.random.choice(idxT[t], size=sample_size, replace=False)
+            idxs = rng.choice(idxT[t], size=sample_size, replace=False)
             hIdx[m] += idxs.tolist()
 
     # estimate the mdodel
@@ -53,7 +43,7 @@ def prop_hazard(M, T_vec, S, H, Lambdas, betas):
     for m in range(M):
         Nh = len(hIdx[m])
 
-        prop_hazard_mdls[m].load(np.array(hS[m])[hIdx[m], :], np.array(hD[m])[hIdx[m]])
+        prop_hazard_mdls[m].load(hS[m][hIdx[m], :], hD[m][hIdx[m]])
 
         prop_hazard_mdls[m].Lambda = prop_hazard_mdls[m].sample_lambda()[-1]
         prop_hazard_mdls[m].betas[0] = prop_hazard_mdls[m].sample_beta(0)[-1]
@@ -75,20 +65,14 @@ def prop_hazard(M, T_vec, S, H, Lambdas, betas):
     return hazard_matrix, new_lambdas, new_betas
 
 
-def cell_hazard(M, T_vec, S, H, h_prior):
+def cell_hazard(M, t_idx, S, H, h_prior, rng=np.random):
+    # t_idx, S, H: the period, the state and the spell end of each observation
     # update the likelihood count
-    K = len(T_vec)
-    T = max(T_vec)
-    h_cnt = np.zeros((M, T, 2))
-    for k in range(K):
-        for t in range(T_vec[k]):
-            h_cnt[S[t, k], t, H[t, k]] += 1
+    T = int(np.max(t_idx)) + 1
+    h_cnt = count_cell((M, T, 2), (S, t_idx, H))
 
     # update the posterior
-    hazard_matrix = np.zeros((M, T))
-    for m in range(M):
-        for t in range(T):
-            hazard_matrix[m, t] = np.random.beta(
-                h_prior[m, t, 0] + h_cnt[m, t, 1], h_prior[m, t, 1] + h_cnt[m, t, 0]
-            )  # hazard rate H=1
+    hazard_matrix = rng.beta(
+        h_prior[:, 0:T, 0] + h_cnt[:, :, 1], h_prior[:, 0:T, 1] + h_cnt[:, :, 0]
+    )  # hazard rate H=1
     return hazard_matrix
@@ -1,6 +1,5 @@
 # encoding: utf-8
 import sys
-from collections import defaultdict
 import copy
 import math
 
@@ -10,91 +9,103 @@ from tqdm import tqdm
 from .util import (
     draw_c,
     draw_l,
+    draw_c_batch,
+    draw_l_batch,
     get_map_estimation,
     get_final_chain,
-    random_choice,
+    random_choice_batch,
     draw_multilevel_pi,
     get_item_dict,
+    count_cell,
+    set_rng_state,
+    save_checkpoint,
+    init_param_chain,
+    safe_log,
+    logExpSum,
+    MCMC_Chain,
+)
+from .data_util import (
+    RaggedSeq,
+    get_ragged_pattern_index,
+    get_log_columns,
+    count_unique,
 )
 from .bfs_util import generate_states, update_state_parmeters
+from .ffbs_util import forward_filtering
 from .hazard_util import prop_hazard, cell_hazard
 
-from joblib import Parallel, delayed
 
+class LTP_HMM_MCMC(MCMC_Chain):
+    # the sampler state saved in a checkpoint besides the chain and the rng
+    chain_state_fields = [
+        "user_mixture_density",
+        "state_init_dist",
+        "state_transit_matrix",
+        "observ_prob_matrix",
+        "effort_prob_matrix",
+        "hazard_matrix",
+        "Lambdas",
+        "betas",
+        "prior_param",
+        "unique_item_num",
+        "item_param_dict",
+        "item_param_array",
+    ]
+
+    # observation arrays the parallel workers map from files
+    shared_data_fields = [
+        "observ_data",
+        "obs_type_patterns",
+        "obs_type_H",
+        "obs_type_cnt",
+        "obs_type_ref",
+    ]
 
-class LTP_HMM_MCMC(object):
     def _load_observ(self, data):
 
-        self.K = len(set([x[0] for x in data]))
-        self.T = max([x[1] for x in data]) + 1
-        self.J = len(set([x[2] for x in data]))
-        self.My = len(set(x[3] for x in data))
-
-        self.H_array = np.empty((self.T, self.K), dtype=np.int)
-        self.E_array = np.empty((self.T, self.K), dtype=np.int)
-        self.O_array = np.empty((self.T, self.K), dtype=np.int)
-        self.J_array = np.empty((self.T, self.K), dtype=np.int)
-        T_array = np.zeros((self.K,))
-
-        for log in data:
-            if len(log) == 4:
-                # The spell never ends; multiple item
-                i, t, j, y = log
-                is_h = 0
-                is_e = 1
-            elif len(log) == 5:
-                i, t, j, y, is_h = log
-                is_e = 1
-            elif len(log) == 6:
-                i, t, j, y, is_h, is_e = log
-            else:
-                raise Exception("The log format is not recognized.")
-            self.O_array[t, i] = y
-            self.J_array[t, i] = j
-            self.H_array[t, i] = is_h
-            self.E_array[t, i] = is_e
-            T_array[i] = t
-
-        # This section is used to collapse states
-        self.T_vec = [int(x) + 1 for x in T_array.tolist()]
-        self.O_data = []
-        for i in range(self.K):
-            self.O_data.append([x for x in self.O_array[0 : self.T_vec[i], i].tolist()])
-        self.J_data = []
-        for i in range(self.K):
-            self.J_data.append([x for x in self.J_array[0 : self.T_vec[i], i].tolist()])
-        self.E_data = []
-        for i in range(self.K):
-            self.E_data.append([x for x in self.E_array[0 : self.T_vec[i], i].tolist()])
-
-        self.H_vec = [int(self.H_array[self.T_vec[i] - 1, i]) for i in range(self.K)]
+        # data: [(i,t,j,y(,h(,e)))], or the same columns as arrays
+        # h defaults to 0 (the spell never ends) and e to 1
+        logs = get_log_columns(data, ["i", "t", "j", "y", "h", "e"], {"h": 0, "e": 1})
+        self.J = count_unique(logs["j"])
+        self.My = count_unique(logs["y"])
+
+        # the logs of each learner are stored back to back, without padding
+        self.observ_data = RaggedSeq.from_logs(
+            logs["i"],
+            logs["t"],
+            {"O": logs["y"], "J": logs["j"], "H": logs["h"], "E": logs["e"]},
+            {"O": np.int8, "J": np.int32, "H": np.int8, "E": np.int8},
+        )
+        self.K = self.observ_data.num_seq
+        self.T = self.observ_data.max_len
 
     def _collapse_obser_state(self):
-        self.obs_type_cnt = defaultdict(int)
-        self.obs_type_ref = {}
-        for k in range(self.K):
-            obs_type_key = (
-                str(self.H_vec[k])
-                + "-"
-                + "|".join(str(y) for y in self.O_data[k])
-                + "-"
-                + "|".join(str(j) for j in self.J_data[k])
-                + "-"
-                + "|".join(str(e) for e in self.E_data[k])
-            )
-            self.obs_type_cnt[obs_type_key] += 1
-            self.obs_type_ref[k] = obs_type_key
-
-        # construct the space
+        # learners with the same O, J, E and the same H at the end of the spell
+        # share the data augmentation
+        (
+            self.obs_type_patterns,
+            self.obs_type_H,
+            self.obs_type_cnt,
+            self.obs_type_ref,
+        ) = get_ragged_pattern_index(
+            self.observ_data, ["O", "J", "E"], self.observ_data.get_last("H")
+        )
+        self.obs_type_info = None
+
+    def _build_obs_type_info(self):
+        # construct the space, converting each field once instead of per pattern
+        patterns = self.obs_type_patterns
+        bounds = patterns.offsets.tolist()
+        fields = {name: patterns[name].tolist() for name in ["O", "J", "E"]}
+        H = self.obs_type_H.tolist()
         self.obs_type_info = {}
-        for key in self.obs_type_cnt.keys():
-            H_s, O_s, J_s, E_s = key.split("-")
-
+        for key in range(patterns.num_seq):
+            start, end = bounds[key], bounds[key + 1]
             self.obs_type_info[key] = {
-                "H": int(H_s),
-                "O": [int(x) for x in O_s.split("|")],
-                "J": [int(x) for x in J_s.split("|")],
-                "E": [int(x) for x in E_s.split("|")],
+                "H": H[key],
+                "O": fields["O"][start:end],
+                "J": fields["J"][start:end],
+                "E": fields["E"][start:end],
             }
 
     def _MCMC(
@@ -105,8 +116,15 @@ class LTP_HMM_MCMC(object):
         is_exit=False,
         hazard_model="cell",
         hazard_state="X",
+        checkpoint_file=None,
+        checkpoint_every=100,
+        chain_state=None,
+        chain_file=None,
+        stop_iter=None,
     ):
         # initialize for iteration
+        if self.obs_type_info is None:
+            self._build_obs_type_info()
         if not is_effort and self.effort_prob_matrix[:, :, 0].sum() != 0:
             raise Exception(
                 "Effort rates are not set to 1 while disabled the update in effort parameter."
@@ -118,13 +136,12 @@ class LTP_HMM_MCMC(object):
             )
 
         lMx = int((self.Mx - 1) * self.Mx * self.J / 2)
-        param_chain = {
-            "l": np.zeros(
-                (max_iter, lMx * self.num_mixture)
-            ),  # for each item, the possible transition is (self.X-1 + 1)* (self.X-1)/2
-            "pi": np.zeros((max_iter, (self.Mx - 1) * self.num_mixture)),
-            "mixture": np.zeros((max_iter, self.num_mixture - 1)),
-            "c": np.zeros((max_iter, (self.Mx * (self.My - 1)) * self.unique_item_num)),
+        # for each item, the possible transition is (self.X-1 + 1)* (self.X-1)/2
+        chain_width = {
+            "l": lMx * self.num_mixture,
+            "pi": (self.Mx - 1) * self.num_mixture,
+            "mixture": self.num_mixture - 1,
+            "c": (self.Mx * (self.My - 1)) * self.unique_item_num,
         }
 
         if is_exit:
@@ -134,22 +151,77 @@ class LTP_HMM_MCMC(object):
                 Mh = self.My
 
             if hazard_model == "prop":
-                self.Lambdas = [self.Lambda for s in range(Mh)]
-                self.betas = [self.beta for s in range(Mh)]
-                param_chain["h"] = np.zeros((max_iter, Mh * 2))
+                if chain_state is None:
+                    self.Lambdas = [self.Lambda for s in range(Mh)]
+                    self.betas = [self.beta for s in range(Mh)]
+                chain_width["h"] = Mh * 2
             elif hazard_model == "cell":
-                param_chain["h"] = np.zeros((max_iter, Mh * self.T))
+                chain_width["h"] = Mh * self.T
 
         if is_effort:
-            param_chain["e"] = np.zeros((max_iter, self.Mx * self.J))
+            chain_width["e"] = self.Mx * self.J
+
+        # chain_file: keep the chain in memory maps on disk instead of RAM
+        # a paused segment has no rows in chain_state, they stay in chain_file
+        is_paused = chain_state is not None and "param_chain" not in chain_state
+        param_chain = init_param_chain(
+            max_iter, chain_width, chain_file, "r+" if is_paused else "w+"
+        )
+
+        if method not in ("BFS", "FFBS"):
+            raise Exception("Algorithm %s not implemented." % method)
 
         # cache the generated states
         X_mat_dict = {}
-        for t in range(1, self.T + 1):
-            X_mat_dict[t] = generate_states(t, self.Mx, self.Mx - 1)
+        if method == "BFS":
+            for t in range(1, self.T + 1):
+                X_mat_dict[t] = generate_states(t, self.Mx, self.Mx - 1)
+
+        # the cells credited with a transition or a response are fixed by the data
+        # transition happens at t, item at t-1 takes credit
+        data = self.observ_data
+        trans_from = np.flatnonzero(data.has_next() & (data["E"] > 0))
+        trans_to = trans_from + 1
+        is_observ = data["E"] != 0
+        if self.is_sparse:
+            # count only the items with data, the rest are drawn from the prior
+            l_items, l_ref = np.unique(data["J"][trans_from], return_inverse=True)
+            c_items, c_ref = np.unique(
+                self.item_param_array[data["J"][is_observ]], return_inverse=True
+            )
+
+        # learners sorted by spell length, the first n_active[t] are still in
+        # the spell at t
+        seq_order = np.argsort(-data.lengths, kind="stable")
+        n_active = np.searchsorted(
+            -data.lengths[seq_order], -np.arange(self.T + 1), side="left"
+        )
 
+        # pick up a checkpointed chain where it stopped
+        start_iter = 0
         tot_error_cnt = 0
-        for iter in tqdm(range(max_iter)):
+        saved_iter = 0
+        if chain_state is not None:
+            start_iter = chain_state["iter"]
+            tot_error_cnt = chain_state["tot_error_cnt"]
+            if start_iter > max_iter:
+                raise Exception(
+                    "The checkpoint has %d iterations, more than max_iter." % start_iter
+                )
+            if not is_paused:
+                for name, chain in chain_state["param_chain"].items():
+                    param_chain[name][0:start_iter] = chain
+            set_rng_state(self.rng, chain_state["rng"])
+            if chain_state.get("file") == checkpoint_file:
+                # the rows before start_iter are already in the checkpoint
+                saved_iter = start_iter
+
+        l_rows, l_cols = np.triu_indices(self.Mx, k=1)
+        last_X = None
+
+        # stop_iter: pause the chain early, the rest of the rows stay empty
+        end_iter = max_iter if stop_iter is None else stop_iter
+        for iter in tqdm(range(start_iter, end_iter)):
 
             if tot_error_cnt > 10:
                 raise Exception("Too many erros in drawing")
@@ -157,26 +229,25 @@ class LTP_HMM_MCMC(object):
             #############################
             # Step 1: Data Augmentation #
             #############################
-            if method == "BFS":
-                # UNIT Test OK
-                for key in self.obs_type_info.keys():
-                    # get the obseration state
-                    O = self.obs_type_info[key]["O"]
-                    H = self.obs_type_info[key]["H"]
-                    J = self.obs_type_info[key]["J"]
-                    E = self.obs_type_info[key]["E"]
-                    # translate the J to item id
-                    item_ids = [self.item_param_dict[j] for j in J]
-                    Ts = len(O)
-                    X_mat = X_mat_dict[Ts]
-
-                    llk_vec = {}
-                    pis = {}
-                    l_mat = {}
-                    z_llk = np.zeros((1, self.num_mixture))
-                    for z in range(self.num_mixture):
-                        llk_vec[z], pis[z], l_mat[z] = update_state_parmeters(
-                            X_mat,
+            # UNIT Test OK
+            for key in self.obs_type_info.keys():
+                # get the obseration state
+                O = self.obs_type_info[key]["O"]
+                H = self.obs_type_info[key]["H"]
+                J = self.obs_type_info[key]["J"]
+                E = self.obs_type_info[key]["E"]
+                # translate the J to item id
+                item_ids = [self.item_param_dict[j] for j in J]
+                Ts = len(O)
+
+                log_llk_vec = {}
+                pis = {}
+                l_mat = {}
+                z_llk = np.zeros((1, self.num_mixture))
+                for z in range(self.num_mixture):
+                    if method == "BFS":
+                        log_llk_vec[z], pis[z], l_mat[z] = update_state_parmeters(
+                            X_mat_dict[Ts],
                             self.Mx,
                             O,
                             E,
@@ -192,40 +263,77 @@ class LTP_HMM_MCMC(object):
                             is_exit,
                             hazard_state,
                         )
-                        z_llk[0, z] = sum(llk_vec[z])
-
-                    self.obs_type_info[key]["user_mixture"] = (
-                        z_llk
-                        * self.user_mixture_density
-                        / np.dot(z_llk, self.user_mixture_density)
-                    ).tolist()[0]
-                    self.obs_type_info[key]["llk_vec"] = llk_vec
-                    self.obs_type_info[key]["pi"] = pis
-                    self.obs_type_info[key]["l_mat"] = l_mat
-            else:
-                raise Exception("Algorithm %s not implemented." % method)
+                    else:
+                        log_llk_vec[z], pis[z], l_mat[z] = forward_filtering(
+                            self.Mx,
+                            O,
+                            E,
+                            H,
+                            J,
+                            item_ids,
+                            self.hazard_matrix,
+                            self.observ_prob_matrix,
+                            self.state_init_dist[z],
+                            self.state_transit_matrix[:, z, :, :, :],
+                            self.effort_prob_matrix,
+                            is_effort,
+                            is_exit,
+                            hazard_state,
+                        )
+                    z_llk[0, z] = logExpSum(log_llk_vec[z])
+
+                # posterior of the user type, normalized in the log space
+                z_post = z_llk + safe_log(self.user_mixture_density)
+                self.obs_type_info[key]["user_mixture"] = np.exp(
+                    z_post - logExpSum(z_post)
+                ).tolist()[0]
+                self.obs_type_info[key]["log_llk_vec"] = log_llk_vec
+                self.obs_type_info[key]["pi"] = pis
+                self.obs_type_info[key]["l_mat"] = l_mat
 
             # sample states backwards
-            X = np.empty((self.T, self.K), dtype=np.int)
-            Z = np.empty((self.K, 1), dtype=np.int)
-            for i in range(self.K):
-                # check the key
-                obs_key = self.obs_type_ref[i]
-                user_mixture = self.obs_type_info[obs_key]["user_mixture"]
-                # sample user type
-                z = random_choice(user_mixture)
-                Z[i] = z
-                # sample the state
-                pi = self.obs_type_info[obs_key]["pi"][z]
-                l_mat = self.obs_type_info[obs_key]["l_mat"][z]
-                Ti = self.T_vec[i]
-
-                X[Ti - 1, i] = random_choice(pi)
-                for t in range(Ti - 1, 0, -1):
-                    pt = l_mat[t, X[t, i], :]
-                    if pt.sum() == 0:
+            # stack the pattern posteriors, then draw all learners at once
+            num_type = len(self.obs_type_info)
+            type_offsets = self.obs_type_patterns.offsets
+            type_mixture = np.zeros((num_type, self.num_mixture))
+            type_pi = np.zeros((num_type, self.num_mixture, self.Mx))
+            # the l_mat of the patterns back to back, as the patterns are stored
+            type_l_mat = np.zeros(
+                (self.num_mixture, self.obs_type_patterns.size, self.Mx, self.Mx)
+            )
+            for p, type_info in self.obs_type_info.items():
+                start, end = type_offsets[p], type_offsets[p + 1]
+                type_mixture[p] = type_info["user_mixture"]
+                for z in range(self.num_mixture):
+                    type_pi[p, z] = type_info["pi"][z]
+                    type_l_mat[z, start:end] = type_info["l_mat"][z]
+
+            # sample user type
+            Z = random_choice_batch(
+                type_mixture[self.obs_type_ref], self.rng
+            ).reshape(self.K, 1)
+            z_vec = Z[:, 0]
+            # sample the state, X is stored flat as the observations
+            X = np.zeros(data.size, dtype=np.int64)
+            seq_type_offsets = type_offsets[self.obs_type_ref]
+            for t in range(self.T - 1, -1, -1):
+                # the learners whose spell ends at t, by learner id
+                start_seq = seq_order[n_active[t + 1] : n_active[t]]
+                if len(start_seq):
+                    X[data.offsets[start_seq] + t] = random_choice_batch(
+                        type_pi[self.obs_type_ref[start_seq], z_vec[start_seq]],
+                        self.rng,
+                    )
+                cont_seq = np.sort(seq_order[0 : n_active[t + 1]])
+                if len(cont_seq):
+                    pt = type_l_mat[
+                        z_vec[cont_seq],
+                        seq_type_offsets[cont_seq] + t + 1,
+                        X[data.offsets[cont_seq] + t + 1],
+                    ]
+                    if np.any(pt.sum(axis=1) == 0):
                         raise Exception("Invalid transition kernel")
-                    X[t - 1, i] = random_choice(pt.tolist())
+                    X[data.offsets[cont_seq] + t] = random_choice_batch(pt, self.rng)
 
             #############################
             # Step 2: Update Parameter  #
@@ -235,86 +343,87 @@ class LTP_HMM_MCMC(object):
                     self.prior_param["mixture"][z] + np.sum(Z == z)
                     for z in range(self.num_mixture)
                 ]
-                new_user_mixture = np.random.dirichlet(user_mixture_param)
+                new_user_mixture = self.rng.dirichlet(user_mixture_param)
 
                 # upate pi | Type 0 and 1 are low mastery, Type 2 are high mastery
+                X_init = X[data.offsets[:-1]]
                 pi_params = [
                     [
-                        self.prior_param["pi"][z][x]
-                        + np.sum(X[0, np.where(Z == z)[0]] == x)
+                        self.prior_param["pi"][z][x] + np.sum(X_init[z_vec == z] == x)
                         for x in range(self.Mx)
                     ]
                     for z in range(self.num_mixture)
                 ]
                 if self.num_mixture > 1:
                     new_state_init_dist = draw_multilevel_pi(
-                        pi_params, self.num_mixture, self.Mx
+                        pi_params, self.num_mixture, self.Mx, self.rng
                     )
                 else:
                     new_state_init_dist = np.zeros((1, self.Mx))
-                    new_state_init_dist[0] = np.random.dirichlet(pi_params[0])
+                    new_state_init_dist[0] = self.rng.dirichlet(pi_params[0])
 
                 # update l
-                trans_matrix = np.zeros(
-                    (self.J, self.num_mixture, self.Mx, self.Mx), dtype=np.int
-                )
-                for k in range(self.K):
-                    z = Z[k]
-                    for t in range(0, self.T_vec[k]):
-                        o_j = self.J_array[t, k]
-                        o_is_e = self.E_array[t, k]
-                        x1 = X[t, k]
-                        if t > 0 and self.E_array[t - 1, k] > 0:
-                            l_j = self.J_array[
-                                t - 1, k
-                            ]  # transition happens at t, item at t-1 takes credit
-                            x0 = X[t - 1, k]
-                            trans_matrix[l_j, z, x0, x1] += 1
-
-                new_state_transit_matrix = np.zeros(
-                    (self.J, self.num_mixture, 2, self.Mx, self.Mx)
-                )
-                for j in range(self.J):
-                    # Need to ensure transition here
-                    state_transit_matrix = np.zeros(
-                        (self.num_mixture, 2, self.Mx, self.Mx)
+                z_from = z_vec[data.seq_index[trans_from]]
+                if self.is_sparse:
+                    trans_cnt = count_cell(
+                        (len(l_items), self.num_mixture, self.Mx, self.Mx),
+                        (l_ref, z_from, X[trans_from], X[trans_to]),
                     )
-                    for z in range(self.num_mixture):
-                        params = [
-                            [
-                                self.prior_param["l"][z][m][n]
-                                + trans_matrix[j, z, m, n]
-                                for n in range(self.Mx)
+                    new_state_transit_matrix = self._draw_sparse_l(l_items, trans_cnt)
+                else:
+                    trans_matrix = count_cell(
+                        (self.J, self.num_mixture, self.Mx, self.Mx),
+                        (data["J"][trans_from], z_from, X[trans_from], X[trans_to]),
+                    ).astype(np.int64)
+
+                    new_state_transit_matrix = np.zeros(
+                        (self.J, self.num_mixture, 2, self.Mx, self.Mx)
+                    )
+                    for j in range(self.J):
+                        # Need to ensure transition here
+                        state_transit_matrix = np.zeros(
+                            (self.num_mixture, 2, self.Mx, self.Mx)
+                        )
+                        for z in range(self.num_mixture):
+                            params = [
+                                [
+                                    self.prior_param["l"][z][m][n]
+                                    + trans_matrix[j, z, m, n]
+                                    for n in range(self.Mx)
+                                ]
+                                for m in range(self.Mx)
                             ]
-                            for m in range(self.Mx)
-                        ]
-                        state_transit_matrix[z] = draw_l(params, self.Mx)
-                    new_state_transit_matrix[j] = state_transit_matrix
+                            state_transit_matrix[z] = draw_l(params, self.Mx, self.rng)
+                        new_state_transit_matrix[j] = state_transit_matrix
 
                 # update c
-                obs_cnt = np.zeros(
-                    (self.unique_item_num, self.Mx, self.My)
-                )  # state,observ
-                for k in range(self.K):
-                    for t in range(0, self.T_vec[k]):
-                        o_j = self.J_array[t, k]
-                        o_is_e = self.E_array[t, k]
-                        if o_is_e:
-                            obs_cnt[
-                                self.item_param_dict[o_j], X[t, k], self.O_array[t, k]
-                            ] += 1
-
-                new_observ_prob_matrix = np.zeros((self.J, self.Mx, self.My))
-                for j in range(self.unique_item_num):
-                    c_params = [
-                        [
-                            self.prior_param["c"][x][y] + obs_cnt[j, x, y]
-                            for y in range(self.My)
+                if self.is_sparse:
+                    obs_cnt = count_cell(
+                        (len(c_items), self.Mx, self.My),
+                        (c_ref, X[is_observ], data["O"][is_observ]),
+                    )
+                    new_observ_prob_matrix = self._draw_sparse_c(c_items, obs_cnt)
+                else:
+                    obs_cnt = count_cell(
+                        (self.unique_item_num, self.Mx, self.My),
+                        (
+                            self.item_param_array[data["J"][is_observ]],
+                            X[is_observ],
+                            data["O"][is_observ],
+                        ),
+                    )  # state,observ
+
+                    new_observ_prob_matrix = np.zeros((self.J, self.Mx, self.My))
+                    for j in range(self.unique_item_num):
+                        c_params = [
+                            [
+                                self.prior_param["c"][x][y] + obs_cnt[j, x, y]
+                                for y in range(self.My)
+                            ]
+                            for x in range(self.Mx)
                         ]
-                        for x in range(self.Mx)
-                    ]
-                    c_draws = draw_c(c_params, self.Mx, self.My)
-                    new_observ_prob_matrix[j] = c_draws
+                        c_draws = draw_c(c_params, self.Mx, self.My, rng=self.rng)
+                        new_observ_prob_matrix[j] = c_draws
 
                 # update h
                 if is_exit:
@@ -322,20 +431,22 @@ class LTP_HMM_MCMC(object):
                         if hazard_state == "X":
                             self.hazard_matrix, self.Lambdas, self.betas = prop_hazard(
                                 self.Mx,
-                                self.T_vec,
+                                data.t_index,
                                 X,
-                                self.H_array,
+                                data["H"],
                                 self.Lambdas,
                                 self.betas,
+                                self.rng,
                             )
                         elif hazard_state == "Y":
                             self.hazard_matrix, self.Lambdas, self.betas = prop_hazard(
                                 self.My,
-                                self.T_vec,
-                                self.O_array,
-                                self.H_array,
+                                data.t_index,
+                                data["O"],
+                                data["H"],
                                 self.Lambdas,
                                 self.betas,
+                                self.rng,
                             )
                         else:
                             raise Exception(
@@ -345,18 +456,20 @@ class LTP_HMM_MCMC(object):
                         if hazard_state == "X":
                             self.hazard_matrix = cell_hazard(
                                 self.Mx,
-                                self.T_vec,
+                                data.t_index,
                                 X,
-                                self.H_array,
+                                data["H"],
                                 self.prior_param["h"],
+                                self.rng,
                             )
                         elif hazard_state == "Y":
                             self.hazard_matrix = cell_hazard(
                                 self.My,
-                                self.T_vec,
-                                self.O_array,
-                                self.H_array,
+                                data.t_index,
+                                data["O"],
+                                data["H"],
                                 self.prior_param["h"],
+                                self.rng,
                             )
                         else:
                             raise Exception(
@@ -367,27 +480,21 @@ class LTP_HMM_MCMC(object):
 
                 # update e
                 if is_effort:
-                    effort_cnt = np.zeros((self.J, self.Mx), dtype=np.int)
-                    effort_state_cnt = np.zeros((self.J, self.Mx), dtype=np.int)
-                    for k in range(self.K):
-                        for t in range(0, self.T_vec[k]):
-                            o_j = self.J_array[t, k]
-                            o_is_e = self.E_array[t, k]
-
-                            effort_cnt[o_j, X[t, k]] += o_is_e
-                            effort_state_cnt[o_j, X[t, k]] += 1
-                    for j in range(self.J):
-                        self.effort_prob_matrix[j] = [
-                            np.random.dirichlet(
-                                (
-                                    self.prior_param["e"][0]
-                                    + effort_state_cnt[j, x]
-                                    - effort_cnt[j, x],
-                                    self.prior_param["e"][1] + effort_cnt[j, x],
-                                )
-                            )
-                            for x in range(self.Mx)
-                        ]
+                    effort_idx = (data["J"], X)
+                    effort_cnt = count_cell(
+                        (self.J, self.Mx), effort_idx, weights=data["E"]
+                    ).astype(np.int64)
+                    effort_state_cnt = count_cell(
+                        (self.J, self.Mx), effort_idx
+                    ).astype(np.int64)
+                    # a two state dirichlet is a beta, drawn for all cells at once
+                    effort_rate = self.rng.beta(
+                        self.prior_param["e"][1] + effort_cnt,
+                        self.prior_param["e"][0] + effort_state_cnt - effort_cnt,
+                    )
+                    self.effort_prob_matrix = np.stack(
+                        [1 - effort_rate, effort_rate], axis=2
+                    )
             except AttributeError as e:
                 tot_error_cnt += 1
                 print(e)
@@ -405,14 +512,12 @@ class LTP_HMM_MCMC(object):
             # Step 3: Preserve the Chain#
             #############################
 
-            lHat_vec = []
-            for z in range(self.num_mixture):
-                for j in range(self.J):
-                    for m in range(self.Mx - 1):
-                        lHat_vec += self.state_transit_matrix[
-                            j, z, 1, m, (m + 1) : self.Mx
-                        ].tolist()
-            param_chain["l"][iter, :] = lHat_vec
+            # the upper triangle of each transition matrix, ordered by z, j, m, n
+            param_chain["l"][iter, :] = (
+                self.state_transit_matrix[:, :, 1, l_rows, l_cols]
+                .transpose(1, 0, 2)
+                .reshape(-1)
+            )
 
             pi_vec = []
             for z in range(self.num_mixture):
@@ -439,9 +544,45 @@ class LTP_HMM_MCMC(object):
             if is_effort:
                 param_chain["e"][iter, :] = self.effort_prob_matrix[:, :, 1].flatten()
             # update parameter chain here
-            self.X = X
+            last_X = X
+
+            if checkpoint_file and (
+                (iter + 1) % checkpoint_every == 0 or iter + 1 == end_iter
+            ):
+                save_checkpoint(
+                    checkpoint_file,
+                    self._get_chain_state(iter + 1, param_chain, tot_error_cnt),
+                    param_chain,
+                    saved_iter,
+                )
+                saved_iter = iter + 1
+        if last_X is not None:
+            # the last draw of the states, T*K as in the responses
+            self.X = data.to_dense(last_X)
+        self.tot_error_cnt = tot_error_cnt
         return param_chain
 
+    def _draw_sparse_l(self, l_items, trans_cnt):
+        # the items without a transition keep the prior as the posterior
+        l_params = np.tile(
+            np.array(self.prior_param["l"], dtype=float), (self.J, 1, 1, 1)
+        )
+        l_params[l_items] += trans_cnt
+        state_transit_matrix = draw_l_batch(
+            l_params.reshape(-1, self.Mx, self.Mx), self.rng
+        )
+        return state_transit_matrix.reshape(
+            self.J, self.num_mixture, 2, self.Mx, self.Mx
+        )
+
+    def _draw_sparse_c(self, c_items, obs_cnt):
+        # the items without a response keep the prior as the posterior
+        c_params = np.tile(
+            np.array(self.prior_param["c"], dtype=float), (self.unique_item_num, 1, 1)
+        )
+        c_params[c_items] += obs_cnt
+        return draw_c_batch(c_params, rng=self.rng)
+
     def _get_initial_param(
         self,
         init_param,
@@ -464,6 +605,9 @@ class LTP_HMM_MCMC(object):
         self.unique_item_num, self.item_param_dict = get_item_dict(
             item_param_constraint, self.J
         )
+        self.item_param_array = np.array(
+            [self.item_param_dict[j] for j in range(self.J)], dtype=np.int64
+        )
 
         # build the prior dist
         # generate parameters from the prior
@@ -516,45 +660,50 @@ class LTP_HMM_MCMC(object):
 
             # TODO: need to implement draws here
             if self.num_mixture > 1:
-                self.user_mixture_density = np.random.dirichlet(
+                self.user_mixture_density = self.rng.dirichlet(
                     self.prior_param["mixture"]
                 )
                 self.state_init_dist = draw_multilevel_pi(
-                    self.prior_param["pi"], self.num_mixture, self.Mx
+                    self.prior_param["pi"], self.num_mixture, self.Mx, self.rng
                 )
             else:
                 self.user_mixture_density = 1.0
                 self.state_init_dist = np.zeros((1, self.Mx))
-                self.state_init_dist[0] = np.random.dirichlet(
+                self.state_init_dist[0] = self.rng.dirichlet(
                     self.prior_param["pi"][0]
                 )  # wrap a list to allow for 1 mixture
 
-            self.state_transit_matrix = np.zeros(
-                (self.J, self.num_mixture, 2, self.Mx, self.Mx)
-            )
-            for j in range(self.J):
-                for z in range(self.num_mixture):
-                    self.state_transit_matrix[j, z, :, :] = draw_l(
-                        self.prior_param["l"][0], self.Mx
-                    )
-
-            self.observ_prob_matrix = np.array(
-                [
-                    draw_c(self.prior_param["c"], self.Mx, self.My)
-                    for j in range(self.unique_item_num)
-                ]
-            )
+            if self.is_sparse:
+                # draw every item at once
+                l_params = np.tile(
+                    np.array(self.prior_param["l"][0], dtype=float),
+                    (self.J * self.num_mixture, 1, 1),
+                )
+                self.state_transit_matrix = draw_l_batch(l_params, self.rng).reshape(
+                    self.J, self.num_mixture, 2, self.Mx, self.Mx
+                )
+                self.observ_prob_matrix = self._draw_sparse_c([], 0)
+            else:
+                self.state_transit_matrix = np.zeros(
+                    (self.J, self.num_mixture, 2, self.Mx, self.Mx)
+                )
+                for j in range(self.J):
+                    for z in range(self.num_mixture):
+                        self.state_transit_matrix[j, z, :, :] = draw_l(
+                            self.prior_param["l"][0], self.Mx, self.rng
+                        )
 
-            if is_effort:
-                self.effort_prob_matrix = np.array(
+                self.observ_prob_matrix = np.array(
                     [
-                        [
-                            np.random.dirichlet(self.prior_param["e"])
-                            for x in range(self.Mx)
-                        ]
-                        for j in range(self.J)
+                        draw_c(self.prior_param["c"], self.Mx, self.My, rng=self.rng)
+                        for j in range(self.unique_item_num)
                     ]
                 )
+
+            if is_effort:
+                self.effort_prob_matrix = self.rng.dirichlet(
+                    self.prior_param["e"], size=(self.J, self.Mx)
+                )
             else:
                 self.effort_prob_matrix = np.zeros((self.J, self.Mx, 2))
                 self.effort_prob_matrix[:, :, 1] = 1.0
@@ -566,13 +715,9 @@ class LTP_HMM_MCMC(object):
                     elif hazard_state == "Y":
                         Mh = self.My
                     self.prior_param["h"] = np.ones((Mh, self.T, 2))
-                    self.hazard_matrix = np.zeros((Mh, self.T))
-                    for m in range(Mh):
-                        for t in range(self.T):
-                            self.hazard_matrix[m, t] = np.random.beta(
-                                self.prior_param["h"][m, t, 0],
-                                self.prior_param["h"][m, t, 1],
-                            )
+                    self.hazard_matrix = self.rng.beta(
+                        self.prior_param["h"][:, :, 0], self.prior_param["h"][:, :, 1]
+                    )
                 elif hazard_model == "prop":
                     self.Lambda = 0.1
                     self.beta = 0.01
@@ -587,34 +732,6 @@ class LTP_HMM_MCMC(object):
                     [[0.0 for t in range(self.T)] for x in range(self.Mx)]
                 )
 
-    def _work(
-        self,
-        max_iter,
-        method,
-        is_effort,
-        is_exit,
-        hazard_model,
-        hazard_state,
-        init_param,
-        prior_dist,
-        zero_mass_set,
-        item_param_constraint,
-    ):
-        self._get_initial_param(
-            init_param,
-            prior_dist,
-            zero_mass_set,
-            item_param_constraint,
-            is_effort,
-            is_exit,
-            hazard_model,
-            hazard_state,
-        )
-        param_chain = self._MCMC(
-            max_iter, method, is_effort, is_exit, hazard_model, hazard_state
-        )
-        return param_chain
-
     def estimate(
         self,
         data_array,
@@ -632,6 +749,16 @@ class LTP_HMM_MCMC(object):
         hazard_model="cell",
         hazard_state="X",
         is_parallel=True,
+        checkpoint_path=None,
+        checkpoint_every=100,
+        resume_from=None,
+        chain_dir=None,
+        is_early_stop=False,
+        diagnose_every=100,
+        rhat_tol=1.01,
+        min_ess=400,
+        seed=None,
+        is_sparse=False,
     ):
 
         # data = [(i,t,j,y,e,h)]
@@ -641,6 +768,9 @@ class LTP_HMM_MCMC(object):
         # y: response, 0 or 1
         # h(azard): if the spell ends here
         # e(effort): 0 or 1
+        # data_array can also be a structured array or a dict of column arrays
+        # with the fields i, t, j, y, h, e, or a 2-D array with the columns in
+        # that order
         self._load_observ(data_array)
         # My: the number of observation state. Assume that all items have the same My. Only 2 and 3 are accepted.
         # Me: number of effort state. Assume that all items have the same Me. Only 2 are accepted.
@@ -655,6 +785,8 @@ class LTP_HMM_MCMC(object):
         else:
             self.Mx = Mx
         self.num_mixture = num_mixture
+        # is_sparse: draw the parameters of all items at once, for large item banks
+        self.is_sparse = is_sparse
 
         if self.num_mixture > 2:
             raise Exception(
@@ -668,45 +800,35 @@ class LTP_HMM_MCMC(object):
 
         self._collapse_obser_state()
 
-        # run MCMC
-        if not is_parallel:
-            param_chain_vec = []
-            for iChain in range(chain_num):
-                self._get_initial_param(
-                    init_param,
-                    prior_dist,
-                    zero_mass_set,
-                    item_param_constraint,
-                    is_effort,
-                    is_exit,
-                    hazard_model,
-                    hazard_state,
-                )
-                tmp_param_chain = self._MCMC(
-                    max_iter, method, is_effort, is_exit, hazard_model, hazard_state
-                )
-                param_chain_vec.append(tmp_param_chain)
-        else:
-            param_chain_vec = Parallel(n_jobs=chain_num)(
-                delayed(self._work)(
-                    max_iter,
-                    method,
-                    is_effort,
-                    is_exit,
-                    hazard_model,
-                    hazard_state,
-                    init_param,
-                    prior_dist,
-                    zero_mass_set,
-                    item_param_constraint,
-                )
-                for i in range(chain_num)
-            )
+        param_chain_vec, num_iter, burn_in = self._run_chains(
+            max_iter,
+            (
+                init_param,
+                prior_dist,
+                zero_mass_set,
+                item_param_constraint,
+                is_effort,
+                is_exit,
+                hazard_model,
+                hazard_state,
+            ),
+            (method, is_effort, is_exit, hazard_model, hazard_state),
+            chain_num,
+            is_parallel,
+            checkpoint_path,
+            checkpoint_every,
+            resume_from,
+            chain_dir,
+            is_early_stop,
+            diagnose_every,
+            rhat_tol,
+            min_ess,
+            seed,
+        )
 
         # process
-        burn_in = min(300, int(max_iter / 2))
         self.param_chain = get_final_chain(
-            param_chain_vec, burn_in, max_iter, is_exit, is_effort
+            param_chain_vec, burn_in, num_iter, is_exit, is_effort
         )
         res = get_map_estimation(self.param_chain, is_exit, is_effort)
 
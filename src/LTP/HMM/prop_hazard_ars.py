@@ -1,9 +1,9 @@
-import random
 import math
-from collections import defaultdict
 
 import numpy as np
 from tqdm import tqdm
+
+from .util import get_pattern_index
 """
 class ARS
 Created on Fri Mar 27 06:46:02 2015
@@ -31,7 +31,7 @@ def prime_llk_lambda(Lambda, betas, x, d):
 # construct the H prime function
 def prime_llk_beta(Lambda, betas, x, d, j):
     exb = np.exp(np.dot(x, betas))
-    return (d - Lambda * exb) / (1 - Lambda * exb) * x[j]
+    return (d - Lambda * exb) / (1 - Lambda * exb) * np.asarray(x)[..., j]
 
 
 """
@@ -70,34 +70,17 @@ print(b1prime, b1prime_sim)
 # sample
 
 
-def tot_llk(Lambda, betas, state_dict):
-    llks = 0
-    for obs_key, cnt in state_dict.items():
-        Ds, Xs = obs_key.split("-")
-        D = int(Ds)
-        X = [int(x) for x in Xs.split("|")]
-        llks += loglikelihood(Lambda, betas, X, D) * cnt
-    return llks
+def tot_llk(Lambda, betas, X, D, cnt):
+    # X, D, cnt: unique covariate/outcome patterns and their counts
+    return np.dot(loglikelihood(Lambda, betas, X, D), cnt)
 
 
-def prime_tot_llk_lambda(Lambda, betas, state_dict):
-    llk_primes = 0
-    for obs_key, cnt in state_dict.items():
-        Ds, Xs = obs_key.split("-")
-        D = int(Ds)
-        X = [int(x) for x in Xs.split("|")]
-        llk_primes += prime_llk_lambda(Lambda, betas, X, D) * cnt
-    return llk_primes
+def prime_tot_llk_lambda(Lambda, betas, X, D, cnt):
+    return np.dot(prime_llk_lambda(Lambda, betas, X, D), cnt)
 
 
-def prime_tot_llk_beta(Lambda, betas, state_dict, j):
-    llk_primes_beta = 0
-    for obs_key, cnt in state_dict.items():
-        Ds, Xs = obs_key.split("-")
-        D = int(Ds)
-        X = [int(x) for x in Xs.split("|")]
-        llk_primes_beta += prime_llk_beta(Lambda, betas, X, D, j) * cnt
-    return llk_primes_beta
+def prime_tot_llk_beta(Lambda, betas, X, D, cnt, j):
+    return np.dot(prime_llk_beta(Lambda, betas, X, D, j), cnt)
 
 
 class ARS:
@@ -119,6 +102,7 @@ class ARS:
         ub=np.Inf,
         use_lower=False,
         ns=50,
+        rng=np.random,
         **fargs
     ):
         """
@@ -139,6 +123,7 @@ class ARS:
 		lb: lower bound of the domain
 		ub: upper bound of the domain
 		ns: maximum number of points defining the hulls
+		rng: random number generator, np.random or a np.random.Generator
 		fargs: arguments for f and fprima
 		"""
 
@@ -147,6 +132,7 @@ class ARS:
         self.f = f
         self.fprima = fprima
         self.fargs = fargs
+        self.rng = rng
 
         # set limit on how many points to maintain on hull
         self.ns = 50
@@ -187,7 +173,7 @@ class ARS:
             ut = self.h[i] + (xt - self.x[i]) * self.hprime[i]
 
             # Accept sample? - Currently don't use lower
-            u = random.random()
+            u = self.rng.random()
             if u < np.exp(ht - ut):
                 samples[n] = xt
                 n += 1
@@ -240,7 +226,7 @@ class ARS:
         """
 		Return a single value randomly sampled from the upper hull and index of segment
 		"""
-        u = random.random()
+        u = self.rng.random()
 
         # Find the largest z such that sc(z) < u
         i = np.nonzero(self.s / self.cu < u)[0][-1]
@@ -277,9 +263,10 @@ class ARS:
 
 
 class ars_sampler(object):
-    def __init__(self, Lambda, betas):
+    def __init__(self, Lambda, betas, rng=np.random):
         self.Lambda = Lambda
         self.betas = betas
+        self.rng = rng
 
     def load(self, X, D):
         # read in the data
@@ -288,23 +275,22 @@ class ars_sampler(object):
         self.N = self.D.shape[0]
 
         # collapse states here
-        self.state_dict = defaultdict(int)
-        for i in range(self.N):
-            obs_key = str(self.D[i]) + "-" + "|".join([str(x) for x in self.X[i, :]])
-            self.state_dict[obs_key] += 1
+        patterns, self.state_cnt, _ = get_pattern_index(
+            np.hstack([np.reshape(self.D, (self.N, 1)), self.X]).astype(np.int64)
+        )
+        self.state_D = patterns[:, 0]
+        self.state_X = patterns[:, 1:]
 
     def sample_lambda(self, n=5):
         def f(x):
-            return tot_llk(x, self.betas, self.state_dict)
+            return tot_llk(x, self.betas, self.state_X, self.state_D, self.state_cnt)
 
         def fprima(x):
-            return prime_tot_llk_lambda(x, self.betas, self.state_dict)
+            return prime_tot_llk_lambda(
+                x, self.betas, self.state_X, self.state_D, self.state_cnt
+            )
 
-        bnds = []
-        for obs_key in self.state_dict.keys():
-            X = [int(x) for x in obs_key.split("-")[1].split("|")]
-            bnds.append(np.exp(-np.dot(X, self.betas)))
-        bnd = min(bnds)
+        bnd = np.exp(-np.dot(self.state_X, self.betas)).min()
 
         is_fail = 0
         # TODO: better first guess
@@ -321,6 +307,7 @@ class ars_sampler(object):
                     xi=[guess_low, (guess_low + guess_high) / 2, guess_high],
                     lb=0.01,
                     ub=bnd,
+                    rng=self.rng,
                 )
             except:
                 is_fail = 1
@@ -347,6 +334,7 @@ class ars_sampler(object):
                     xi=[guess_low, (guess_low + guess_high) / 2, guess_high],
                     lb=0.01,
                     ub=bnd,
+                    rng=self.rng,
                 )
             else:
                 is_fail = 1
@@ -363,27 +351,24 @@ class ars_sampler(object):
         def f(x):
             betas = np.copy(self.betas)
             betas[k] = x
-            return tot_llk(self.Lambda, betas, self.state_dict)
+            return tot_llk(
+                self.Lambda, betas, self.state_X, self.state_D, self.state_cnt
+            )
 
         def fprima(x):
             betas = np.copy(self.betas)
             betas[k] = x
-            return prime_tot_llk_beta(self.Lambda, betas, self.state_dict, k)
+            return prime_tot_llk_beta(
+                self.Lambda, betas, self.state_X, self.state_D, self.state_cnt, k
+            )
 
         # only consider Xj!=0, it needs to be smaller than (-log(lambda)-X!=jb!=j)/Xj
         # also assume Xj>0 for now, otherwise needs to specify lower bnds by max((-log(lambda)-X!=jb!=j)/Xj)
-        bnds = []
-        for obs_key in self.state_dict.keys():
-            X = [int(x) for x in obs_key.split("-")[1].split("|")]
-            if X[k] != 0:
-                bnds.append(
-                    (
-                        -np.log(self.Lambda)
-                        - (np.dot(X, self.betas) - X[k] * self.betas[k])
-                    )
-                    / X[k]
-                )
-        bnd = min(bnds)
+        Xk = self.state_X[self.state_X[:, k] != 0]
+        bnd = (
+            (-np.log(self.Lambda) - (np.dot(Xk, self.betas) - Xk[:, k] * self.betas[k]))
+            / Xk[:, k]
+        ).min()
 
         # check input validity
         guess_low = min(-0.3, self.betas[k] - 0.1)
@@ -399,6 +384,7 @@ class ars_sampler(object):
                     xi=[guess_low, (guess_low + guess_high) / 2, guess_high],
                     lb=-1,
                     ub=bnd,
+                    rng=self.rng,
                 )
             except:
                 is_fail = 1
@@ -427,6 +413,7 @@ class ars_sampler(object):
                     xi=[guess_low, (guess_low + guess_high) / 2, guess_high],
                     lb=-1,
                     ub=bnd,
+                    rng=self.rng,
                 )
             else:
                 is_fail = 1
@@ -0,0 +1,100 @@
+import numpy as np
+
+from .util import forward_update_mastery, compute_success_rate
+
+
+class BKT_Tracer(object):
+    # Keep the current mastery of each (learner, skill) for online serving
+    # param: {"s":[], "g":[], "pi":[], "l":[]}, indexed by skill id from 0:S-1
+    # learner id is from 0:N-1, the table grows when new learners arrive
+    def __init__(self, param, num_learner=0):
+        self.s = np.array(param["s"], dtype=float).reshape(-1)  # slippage
+        self.g = np.array(param["g"], dtype=float).reshape(-1)  # guess
+        self.pi = np.array(param["pi"], dtype=float).reshape(-1)  # initial mastery
+        self.l = np.array(param["l"], dtype=float).reshape(-1)  # learn speed
+        self.num_skill = self.s.shape[0]
+        if any(x.shape[0] != self.num_skill for x in [self.g, self.pi, self.l]):
+            raise ValueError("Parameters have different number of skills.")
+
+        self.num_learner = 0
+        self.mastery = np.empty((0, self.num_skill))
+        self._reserve(num_learner)
+
+    def _reserve(self, num_learner):
+        # double the capacity to amortize the copy
+        if num_learner > self.mastery.shape[0]:
+            capacity = max(num_learner, 2 * self.mastery.shape[0])
+            mastery = np.empty((capacity, self.num_skill))
+            mastery[0 : self.num_learner] = self.mastery[0 : self.num_learner]
+            mastery[self.num_learner :] = self.pi
+            self.mastery = mastery
+        self.num_learner = max(self.num_learner, num_learner)
+
+    def _check_ids(self, learner_ids, skill_ids):
+        if skill_ids.min() < 0 or skill_ids.max() >= self.num_skill:
+            raise ValueError("Unknown skill id.")
+        if learner_ids.min() < 0:
+            raise ValueError("Invalid learner id.")
+
+    def update(self, learner_ids, skill_ids, Y):
+        # apply a batch of (learner, skill, response) events in arrival order
+        # return the predicted success rate of the next response after each event
+        learner_ids = np.asarray(learner_ids, dtype=np.int64).reshape(-1)
+        skill_ids = np.asarray(skill_ids, dtype=np.int64).reshape(-1)
+        Y = np.asarray(Y).reshape(-1)
+        N = learner_ids.shape[0]
+        if skill_ids.shape[0] != N or Y.shape[0] != N:
+            raise ValueError("Events have different lengths.")
+        if N == 0:
+            return np.empty((0,))
+        # check the whole batch before any learner is added or updated
+        self._check_ids(learner_ids, skill_ids)
+        if np.any((Y != 0) & (Y != 1)):
+            raise ValueError("Invalid response value.")
+        self._reserve(int(learner_ids.max()) + 1)
+
+        # The events of the same learner/skill have to be applied in sequence.
+        # Rank them by arrival, and update one rank at a time.
+        key = learner_ids * self.num_skill + skill_ids
+        order = np.argsort(key, kind="stable")
+        sorted_key = key[order]
+        is_first = np.ones((N,), dtype=bool)
+        is_first[1:] = sorted_key[1:] != sorted_key[:-1]
+        first_pos = np.maximum.accumulate(np.where(is_first, np.arange(N), 0))
+        rank = np.empty((N,), dtype=np.int64)
+        rank[order] = np.arange(N) - first_pos
+
+        # the prediction of an event is made from the state right after it, as
+        # if the events were sent one at a time
+        yHat = np.empty((N,))
+        for r in range(rank.max() + 1):
+            idx = rank == r
+            i = learner_ids[idx]
+            j = skill_ids[idx]
+            self.mastery[i, j] = forward_update_mastery(
+                self.mastery[i, j], self.s[j], self.g[j], self.l[j], Y[idx]
+            )
+            yHat[idx] = compute_success_rate(self.s[j], self.g[j], self.mastery[i, j])
+
+        return yHat
+
+    def predict(self, learner_ids, skill_ids):
+        learner_ids = np.asarray(learner_ids, dtype=np.int64).reshape(-1)
+        skill_ids = np.asarray(skill_ids, dtype=np.int64).reshape(-1)
+        mastery = self.get_mastery(learner_ids, skill_ids)
+        return compute_success_rate(self.s[skill_ids], self.g[skill_ids], mastery)
+
+    def get_mastery(self, learner_ids, skill_ids):
+        learner_ids = np.asarray(learner_ids, dtype=np.int64).reshape(-1)
+        skill_ids = np.asarray(skill_ids, dtype=np.int64).reshape(-1)
+        if learner_ids.shape[0] != skill_ids.shape[0]:
+            raise ValueError("Events have different lengths.")
+        if learner_ids.shape[0] == 0:
+            return np.empty((0,))
+        # a negative id would wrap around to the end of the table
+        self._check_ids(learner_ids, skill_ids)
+        # learners never seen are at the initial mastery
+        mastery = self.pi[skill_ids].copy()
+        is_known = learner_ids < self.num_learner
+        mastery[is_known] = self.mastery[learner_ids[is_known], skill_ids[is_known]]
+        return mastery
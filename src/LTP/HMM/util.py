@@ -1,23 +1,54 @@
 # TODO: Update the learning curve generator
 # TODO: Add the joint response generator
-import random
+import copy
+import os
+import pickle
+import shutil
+import tempfile
 from itertools import accumulate
 
 import numpy as np
+from joblib import Parallel, delayed
 
-def random_choice(p_vec):
+from .data_util import get_pattern_index, pack_shared_data, unpack_shared_data
+
+
+def random_choice(p_vec, rng=np.random):
     cump = list(accumulate(p_vec))
     n = len(p_vec)
 
     if abs(cump[n - 1] - 1) > 1e-6:
         raise ValueError("probability does not add up to 1.")
-    rn = random.random()
+    rn = rng.random()
     for x in range(n):
         if rn < cump[x]:
             break
     return x
 
 
+def random_choice_batch(p_mat, rng=np.random):
+    # inverse cdf sampling, one draw for each row of the N*M probability matrix
+    cump = np.cumsum(p_mat, axis=1)
+    n = cump.shape[1]
+
+    if np.any(np.abs(cump[:, n - 1] - 1) > 1e-6):
+        raise ValueError("probability does not add up to 1.")
+    rn = rng.random((cump.shape[0], 1))
+    x = (rn >= cump).sum(axis=1)
+    return np.minimum(x, n - 1)
+
+
+def count_cell(shape, idx, weights=None):
+    # scatter-add: count the occurrence of each cell of an array with shape
+    # idx: tuple of int arrays, one per dimension
+    cnt = np.bincount(
+        np.ravel_multi_index(idx, shape),
+        weights=weights,
+        minlength=int(np.prod(shape)),
+    )
+    return cnt.reshape(shape)
+
+
 def update_mastery(mastery, learn_rate):
     return mastery + (1 - mastery) * learn_rate
 
@@ -28,16 +59,19 @@ def compute_success_rate(slip, guess, mastery):
 
 # Bayesian Knowledge Tracing Algorithm
 def forward_update_mastery(mastery, slip, guess, learn_rate, Y):
-    if Y == 1:
-        new_mastery = 1 - (1 - learn_rate) * (1 - mastery) * guess / (
-            guess + (1 - slip - guess) * mastery
-        )
-    elif Y == 0:
-        new_mastery = 1 - (1 - learn_rate) * (1 - mastery) * (1 - guess) / (
-            1 - guess - (1 - slip - guess) * mastery
-        )
-    else:
+    # all inputs can be arrays of the same shape, one element per event
+    Y = np.asarray(Y)
+    if np.any((Y != 0) & (Y != 1)):
         raise ValueError("Invalid response value.")
+    mastery_right = 1 - (1 - learn_rate) * (1 - mastery) * guess / (
+        guess + (1 - slip - guess) * mastery
+    )
+    mastery_wrong = 1 - (1 - learn_rate) * (1 - mastery) * (1 - guess) / (
+        1 - guess - (1 - slip - guess) * mastery
+    )
+    new_mastery = np.where(Y == 1, mastery_right, mastery_wrong)
+    if new_mastery.ndim == 0:
+        new_mastery = float(new_mastery)
     return new_mastery
 
 
@@ -50,8 +84,18 @@ def generate_learning_curve(slip, guess, init_mastery, learn_rate, T):
     return lc
 
 
+def safe_log(x):
+    # log(0) is -inf without the warning
+    with np.errstate(divide="ignore"):
+        return np.log(x)
+
+
 def logExpSum(llk_vec):
-    llk_max = max(llk_vec)
+    llk_vec = np.asarray(llk_vec, dtype=float)
+    llk_max = llk_vec.max()
+    if llk_max == -np.inf:
+        # every term is 0
+        return -np.inf
     llk_sum = llk_max + np.log(np.exp(llk_vec - llk_max).sum())
     return llk_sum
 
@@ -67,7 +111,7 @@ def check_two_state_rank_order(c_mat):
     return is_valid
 
 
-def draw_c(param, Mx, My, max_iter=100):
+def draw_c(param, Mx, My, max_iter=100, rng=np.random):
     if len(param) != Mx:
         raise ValueError("Observation matrix is wrong on latent state dimension.")
     if len(param[0]) != My:
@@ -78,18 +122,18 @@ def draw_c(param, Mx, My, max_iter=100):
         iter = 0
         while not check_two_state_rank_order(c_mat) and iter < max_iter:
             for n in range(Mx):
-                c_mat[n, :] = np.random.dirichlet(param[n])
+                c_mat[n, :] = rng.dirichlet(param[n])
             iter += 1
         if iter == max_iter:
             raise Exception("C is not drew.")
     else:
         for n in range(Mx):
-            c_mat[n, :] = np.random.dirichlet(param[n])
+            c_mat[n, :] = rng.dirichlet(param[n])
 
     return c_mat
 
 
-def draw_l(params, Mx):
+def draw_l(params, Mx, rng=np.random):
 
     l_param = np.zeros((2, Mx, Mx))
     l_param[0] = np.identity(Mx)
@@ -102,11 +146,50 @@ def draw_l(params, Mx):
         if num_l_to_draw == 0:
             raise Exception("learning rate parameters is wrong")
         else:
-            valid_l_param = np.random.dirichlet(valid_params)
+            valid_l_param = rng.dirichlet(valid_params)
         l_param[1][m, (len(params[m])-num_l_to_draw):] = valid_l_param
     return l_param
 
 
+def draw_dirichlet_batch(params, rng=np.random):
+    # one dirichlet draw along the last axis for every row, by gamma normalisation
+    # a zero parameter gives zero probability
+    g = rng.gamma(np.asarray(params, dtype=float))
+    g_sum = g.sum(axis=-1, keepdims=True)
+    if np.any(g_sum == 0):
+        raise Exception("Dirichlet parameters are all zero.")
+    return g / g_sum
+
+
+def draw_c_batch(params, max_iter=100, rng=np.random):
+    # params: N*Mx*My, draw the observation matrix of N items at once
+    params = np.asarray(params, dtype=float)
+    c_mat = draw_dirichlet_batch(params, rng)
+    if params.shape[2] == 2:
+        # redraw the items that break the rank order c[k,1]<c[k+1,1]
+        iter = 1
+        is_invalid = np.any(np.diff(c_mat[:, :, 1], axis=1) <= 0, axis=1)
+        while is_invalid.any() and iter < max_iter:
+            c_mat[is_invalid] = draw_dirichlet_batch(params[is_invalid], rng)
+            is_invalid = np.any(np.diff(c_mat[:, :, 1], axis=1) <= 0, axis=1)
+            iter += 1
+        if is_invalid.any():
+            raise Exception("C is not drew.")
+    return c_mat
+
+
+def draw_l_batch(params, rng=np.random):
+    # params: N*Mx*Mx, draw the transition matrix of N items at once
+    params = np.asarray(params, dtype=float)
+    if np.any(params.sum(axis=2) == 0):
+        raise Exception("learning rate parameters is wrong")
+    N, Mx = params.shape[0:2]
+    l_param = np.zeros((N, 2, Mx, Mx))
+    l_param[:, 0] = np.identity(Mx)
+    l_param[:, 1] = draw_dirichlet_batch(params, rng)
+    return l_param
+
+
 def check_multi_level_pi(state_init_dist, num_mixture):
     is_valid = True
     for z in range(1, num_mixture):
@@ -118,7 +201,7 @@ def check_multi_level_pi(state_init_dist, num_mixture):
     return is_valid
 
 
-def draw_multilevel_pi(pi_params, num_mixture, Mx):
+def draw_multilevel_pi(pi_params, num_mixture, Mx, rng=np.random):
     state_init_dist = np.zeros((num_mixture, Mx))
     max_pi_iter = 100
     pi_iter = 0
@@ -126,7 +209,7 @@ def draw_multilevel_pi(pi_params, num_mixture, Mx):
         not check_multi_level_pi(state_init_dist, num_mixture) and pi_iter < max_pi_iter
     ):
         for z in range(num_mixture):
-            state_init_dist[z] = np.random.dirichlet(pi_params[z])
+            state_init_dist[z] = rng.dirichlet(pi_params[z])
         pi_iter += 1
     if pi_iter == max_pi_iter:
         raise Exception("Initial density are not drew")
@@ -134,7 +217,7 @@ def draw_multilevel_pi(pi_params, num_mixture, Mx):
         return state_init_dist
 
 
-def draw_multilevel_l(param_slow, param_fast, param_high, Mx):
+def draw_multilevel_l(param_slow, param_fast, param_high, Mx, rng=np.random):
     state_transit_matrix = np.zeros((3, 2, Mx, Mx))
     transit_slow = np.zeros((2, Mx, Mx))
     transit_fast = np.zeros((2, Mx, Mx))
@@ -143,9 +226,9 @@ def draw_multilevel_l(param_slow, param_fast, param_high, Mx):
     l_iter = 0
     # TODO: can only impose two state constraints
     while transit_slow[1, 0, 1] >= transit_fast[1, 0, 1] and l_iter < l_max_iter:
-        transit_slow = draw_l(param_slow, Mx)
-        transit_fast = draw_l(param_fast, Mx)
-        transit_high = draw_l(param_high, Mx)
+        transit_slow = draw_l(param_slow, Mx, rng)
+        transit_fast = draw_l(param_fast, Mx, rng)
+        transit_high = draw_l(param_high, Mx, rng)
         l_iter += 1
 
     if l_iter == l_max_iter:
@@ -160,7 +243,8 @@ def draw_multilevel_l(param_slow, param_fast, param_high, Mx):
 def get_final_chain(param_chain_vec, start, end, is_exit, is_effort):
     # calcualte the llk for the parameters
     gap = max(int((end - start) / 100), 10)
-    select_idx = range(start, end, gap)
+    # a strided slice only touches the kept rows of a disk backed chain
+    select_idx = slice(start, end, gap)
     num_chain = len(param_chain_vec)
 
     # get rid of burn in
@@ -190,6 +274,84 @@ def get_final_chain(param_chain_vec, start, end, is_exit, is_effort):
     return param_chain
 
 
+def get_split_chain(chains):
+    # chains: chain*iter*param, cut each chain in halves
+    n = int(chains.shape[1] / 2)
+    return np.concatenate([chains[:, 0:n], chains[:, n : 2 * n]], axis=0)
+
+
+def get_split_rhat(chains):
+    # split R-hat of each column, chains: chain*iter*param
+    split_chains = get_split_chain(chains)
+    n = split_chains.shape[1]
+    B = n * split_chains.mean(axis=1).var(axis=0, ddof=1)
+    W = split_chains.var(axis=1, ddof=1).mean(axis=0)
+    var_hat = (n - 1) / n * W + B / n
+    # a constant column has nothing to mix
+    rhat = np.ones(W.shape)
+    is_var = W > 0
+    rhat[is_var] = np.sqrt(var_hat[is_var] / W[is_var])
+    return rhat
+
+
+def get_ess(chains):
+    # effective sample size of each column, chains: chain*iter*param
+    # autocorrelation is truncated at the first negative sum of a lag pair
+    split_chains = get_split_chain(chains)
+    m, n = split_chains.shape[0:2]
+    x = split_chains - split_chains.mean(axis=1, keepdims=True)
+    f = np.fft.rfft(x, n=2 * n, axis=1)
+    acov = np.fft.irfft(f * np.conj(f), n=2 * n, axis=1)[:, 0:n] / n
+    W = (acov[:, 0] * n / (n - 1)).mean(axis=0)
+    var_hat = (n - 1) / n * W + split_chains.mean(axis=1).var(axis=0, ddof=1)
+    ess = np.full(W.shape, float(m * n))
+    is_var = W > 0
+    rho = 1 - (W[is_var] - acov[:, :, is_var].mean(axis=0)) / var_hat[is_var]
+    num_pair = int(n / 2)
+    pair_sum = rho[0 : 2 * num_pair : 2] + rho[1 : 2 * num_pair : 2]
+    is_positive = np.cumprod(pair_sum > 0, axis=0)
+    tau = -1 + 2 * (pair_sum * is_positive).sum(axis=0)
+    ess[is_var] = m * n / np.maximum(tau, 1.0 / np.log10(m * n))
+    return ess
+
+
+def get_chain_diagnostics(param_chain_vec, start, end, col_size=100):
+    # worst split R-hat and ESS of each parameter block after the burn in
+    # columns are read in chunks to bound the memory of a disk backed chain
+    diagnostics = {}
+    if end - start < 4:
+        return diagnostics
+    for name in param_chain_vec[0].keys():
+        num_col = param_chain_vec[0][name].shape[1]
+        if num_col == 0:
+            continue
+        rhat = []
+        ess = []
+        for col in range(0, num_col, col_size):
+            chains = np.stack(
+                [
+                    np.asarray(param_chain[name][start:end, col : col + col_size])
+                    for param_chain in param_chain_vec
+                ]
+            )
+            rhat.append(get_split_rhat(chains))
+            ess.append(get_ess(chains))
+        diagnostics[name] = {
+            "rhat": float(np.concatenate(rhat).max()),
+            "ess": float(np.concatenate(ess).min()),
+        }
+    return diagnostics
+
+
+def is_chain_converged(diagnostics, rhat_tol, min_ess):
+    if not diagnostics:
+        return False
+    return all(
+        diag["rhat"] <= rhat_tol and diag["ess"] >= min_ess
+        for diag in diagnostics.values()
+    )
+
+
 def get_map_estimation(param_chain, is_exit, is_effort):
     res = {}
     res["l"] = param_chain["l"].mean(axis=0).tolist()
@@ -242,8 +404,416 @@ def get_item_dict(item_param_constraint, J):
     return unique_item_num, item_param_dict
 
 
+def init_param_chain(max_iter, chain_width, chain_file=None, mode="w+"):
+    # chain_width: number of columns of each field
+    # chain_file: back each field with a memmap at <chain_file>.<field>
+    # mode: "w+" creates the files, "r+" opens the rows of a paused chain
+    param_chain = {}
+    if chain_file is not None and mode == "w+":
+        make_parent_dir(chain_file)
+    for name, width in chain_width.items():
+        if chain_file is None or max_iter * width == 0:
+            param_chain[name] = np.zeros((max_iter, width))
+        else:
+            param_chain[name] = np.memmap(
+                "%s.%s" % (chain_file, name),
+                dtype=np.float64,
+                mode=mode,
+                shape=(max_iter, width),
+            )
+    return param_chain
+
+
+def dump_param_chain(param_chain):
+    # pass the disk backed fields by file rather than by value
+    res = {}
+    for name, chain in param_chain.items():
+        if isinstance(chain, np.memmap):
+            chain.flush()
+            res[name] = {"file": chain.filename, "shape": chain.shape}
+        else:
+            res[name] = chain
+    return res
+
+
+def load_param_chain(param_chain):
+    res = {}
+    for name, chain in param_chain.items():
+        if isinstance(chain, dict):
+            res[name] = np.memmap(
+                chain["file"], dtype=np.float64, mode="r", shape=chain["shape"]
+            )
+        else:
+            res[name] = chain
+    return res
+
+
+def get_chain_file(chain_dir, chain_id):
+    return os.path.join(chain_dir, "chain%d" % chain_id)
+
+
+def make_parent_dir(file_path):
+    # e.g. chk/ of the chain or checkpoint files chk/run.chain0
+    dir_path = os.path.dirname(file_path)
+    if dir_path:
+        os.makedirs(dir_path, exist_ok=True)
+
+
+def dump_shared_data(data, data_dir):
+    # save each array for the workers to map read-only
+    data_files = {}
+    for name, arr in data.items():
+        file_path = os.path.join(data_dir, "%s.npy" % name)
+        np.save(file_path, arr)
+        data_files[name] = file_path
+    return data_files
+
+
+def load_shared_data(data_files):
+    return {
+        name: np.load(file_path, mmap_mode="r")
+        for name, file_path in data_files.items()
+    }
+
+
+def get_chain_seeds(seed, chain_num):
+    # independent streams for the chains, reproducible given the seed
+    return np.random.SeedSequence(seed).spawn(chain_num)
+
+
+def get_rng_state(rng):
+    return copy.deepcopy(rng.bit_generator.state)
+
+
+def set_rng_state(rng, rng_state):
+    rng.bit_generator.state = rng_state
+
+
+def get_checkpoint_file(checkpoint_path, chain_id):
+    return "%s.chain%d" % (checkpoint_path, chain_id)
+
+
+def save_checkpoint(file_path, state, param_chain=None, saved_iter=0):
+    # the chain rows sit in <file_path>.<field>, only the rows from saved_iter
+    # on are written. The state is swapped in last, so it never refers to rows
+    # that are not on disk yet.
+    make_parent_dir(file_path)
+    if param_chain is not None:
+        for name, chain in param_chain.items():
+            write_chain_rows(
+                "%s.%s" % (file_path, name), chain, saved_iter, state["iter"]
+            )
+    # write to a temporary file and swap, a crash never leaves a partial file
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+
+def write_chain_rows(file_path, chain, start, end):
+    # overwrite from row start, rows left behind by a crash are truncated
+    mode = "r+b" if os.path.exists(file_path) else "wb"
+    with open(file_path, mode) as f:
+        f.seek(start * chain.shape[1] * 8)
+        f.write(np.ascontiguousarray(chain[start:end], dtype=np.float64).tobytes())
+        f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def load_checkpoint(file_path):
+    with open(file_path, "rb") as f:
+        state = pickle.load(f)
+    # map the saved rows, they are copied once into the resumed chain
+    state["param_chain"] = {}
+    for name, width in state["chain_width"].items():
+        if state["iter"] * width == 0:
+            state["param_chain"][name] = np.zeros((state["iter"], width))
+        else:
+            state["param_chain"][name] = np.memmap(
+                "%s.%s" % (file_path, name),
+                dtype=np.float64,
+                mode="r",
+                shape=(state["iter"], width),
+            )
+    state["file"] = file_path
+    return state
+
+
+class MCMC_Chain(object):
+    """
+    The chain orchestration shared by the MCMC estimators: checkpoint and
+    resume, chains on disk, early stop segments and parallel workers. A
+    parallel worker receives the estimator without its shared_data_fields and
+    maps them from files.
+
+    The estimator implements
+    _get_initial_param(*init_args): draw the starting parameters
+    _MCMC(max_iter, *mcmc_args, checkpoint_file, checkpoint_every,
+          chain_state, chain_file, stop_iter): run the chain, return its rows
+    """
+
+    # the sampler state saved in a checkpoint besides the chain and the rng
+    chain_state_fields = []
+    # observation arrays the parallel workers map from files
+    shared_data_fields = []
+    shared_data_files = None
+    # the pattern lists of the data augmentation, built when the sampling starts
+    obs_type_info = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.shared_data_files:
+            # the worker rebuilds these from the mapped files
+            for name in self.shared_data_fields + ["obs_type_info"]:
+                state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.shared_data_files:
+            self.__dict__.update(
+                unpack_shared_data(load_shared_data(self.shared_data_files))
+            )
+
+    def _get_chain_state(self, num_iter, param_chain, tot_error_cnt):
+        # the chain rows are saved apart, see save_checkpoint
+        state = {
+            "iter": num_iter,
+            "tot_error_cnt": tot_error_cnt,
+            "chain_width": {
+                name: chain.shape[1] for name, chain in param_chain.items()
+            },
+            "rng": get_rng_state(self.rng),
+            "param": {},
+        }
+        for name in self.chain_state_fields:
+            if hasattr(self, name):
+                state["param"][name] = copy.deepcopy(getattr(self, name))
+        return state
+
+    def _set_chain_state(self, chain_state):
+        for name, value in chain_state["param"].items():
+            setattr(self, name, copy.deepcopy(value))
+
+    def _work(
+        self,
+        max_iter,
+        init_args,
+        mcmc_args,
+        checkpoint_file=None,
+        checkpoint_every=100,
+        resume_file=None,
+        chain_file=None,
+        seed_seq=None,
+    ):
+        self.rng = np.random.default_rng(seed_seq)
+        if resume_file:
+            chain_state = load_checkpoint(resume_file)
+            self._set_chain_state(chain_state)
+        else:
+            chain_state = None
+            self._get_initial_param(*init_args)
+        param_chain = self._MCMC(
+            max_iter,
+            *mcmc_args,
+            checkpoint_file,
+            checkpoint_every,
+            chain_state,
+            chain_file,
+        )
+        # a disk backed chain is returned by file to the parent process
+        return dump_param_chain(param_chain)
+
+    def _work_segment(
+        self,
+        max_iter,
+        init_args,
+        mcmc_args,
+        checkpoint_file,
+        checkpoint_every,
+        chain_file,
+        chain_state,
+        stop_iter,
+        seed_seq,
+    ):
+        # run the chain up to stop_iter and hand back its state, the rows stay
+        # in chain_file for the next segment
+        self.rng = np.random.default_rng(seed_seq)
+        if chain_state is None:
+            self._get_initial_param(*init_args)
+        else:
+            self._set_chain_state(chain_state)
+        param_chain = self._MCMC(
+            max_iter,
+            *mcmc_args,
+            checkpoint_file,
+            checkpoint_every,
+            chain_state,
+            chain_file,
+            stop_iter,
+        )
+        chain_state = self._get_chain_state(stop_iter, param_chain, self.tot_error_cnt)
+        chain_state["chain_file"] = dump_param_chain(param_chain)
+        # the last iteration of the segment is always checkpointed
+        chain_state["file"] = checkpoint_file
+        return chain_state
+
+    def _run_chains(
+        self,
+        max_iter,
+        init_args,
+        mcmc_args,
+        chain_num,
+        is_parallel,
+        checkpoint_path,
+        checkpoint_every,
+        resume_from,
+        chain_dir,
+        is_early_stop,
+        diagnose_every,
+        rhat_tol,
+        min_ess,
+        seed,
+    ):
+        # run chain_num chains, set the diagnostics of the estimator
+        # return the chains, the number of iterations and the burn in
+        # checkpoint: each chain is saved to checkpoint_path.chain{i}
+        # resume_from: the checkpoint_path of an interrupted run with the same data
+        if resume_from and not checkpoint_path:
+            checkpoint_path = resume_from
+        checkpoint_files = [
+            get_checkpoint_file(checkpoint_path, i) if checkpoint_path else None
+            for i in range(chain_num)
+        ]
+        resume_files = [
+            get_checkpoint_file(resume_from, i) if resume_from else None
+            for i in range(chain_num)
+        ]
+        # chain_dir: store each field of chain i at chain_dir/chain{i}.{field}
+        chain_files = [
+            get_chain_file(chain_dir, i) if chain_dir else None
+            for i in range(chain_num)
+        ]
+
+        # the chain files of an early stopped run without a chain_dir
+        segment_dir = None
+
+        # seed: each chain draws from its own generator spawned from the seed
+        chain_seeds = get_chain_seeds(seed, chain_num)
+
+        # parallel workers map the observation from files instead of copies
+        if is_parallel:
+            data_dir = tempfile.mkdtemp()
+            self.shared_data_files = dump_shared_data(
+                pack_shared_data(
+                    {name: getattr(self, name) for name in self.shared_data_fields}
+                ),
+                data_dir,
+            )
+        diagnostics = None
+        try:
+            if is_early_stop:
+                # run the chains in segments, stop all once they have mixed
+                # each segment extends the chain in its file, the diagnostics
+                # map the files read-only
+                if not chain_dir:
+                    segment_dir = tempfile.mkdtemp()
+                    chain_files = [
+                        get_chain_file(segment_dir, i) for i in range(chain_num)
+                    ]
+                chain_states = [
+                    load_checkpoint(resume_file) if resume_file else None
+                    for resume_file in resume_files
+                ]
+                num_iter = max([0] + [s["iter"] for s in chain_states if s is not None])
+                # a resumed run may have no segment left to run
+                param_chain_vec = [
+                    s["param_chain"] for s in chain_states if s is not None
+                ]
+                while num_iter < max_iter:
+                    num_iter = min(num_iter + diagnose_every, max_iter)
+                    segment_args = [
+                        (
+                            max_iter,
+                            init_args,
+                            mcmc_args,
+                            checkpoint_files[i],
+                            checkpoint_every,
+                            chain_files[i],
+                            chain_states[i],
+                            num_iter,
+                            chain_seeds[i],
+                        )
+                        for i in range(chain_num)
+                    ]
+                    if not is_parallel:
+                        chain_states = [
+                            self._work_segment(*args) for args in segment_args
+                        ]
+                    else:
+                        chain_states = Parallel(n_jobs=chain_num)(
+                            delayed(self._work_segment)(*args) for args in segment_args
+                        )
+                    param_chain_vec = [
+                        load_param_chain(s["chain_file"]) for s in chain_states
+                    ]
+                    burn_in = min(300, int(num_iter / 2))
+                    diagnostics = get_chain_diagnostics(
+                        param_chain_vec, burn_in, num_iter
+                    )
+                    if is_chain_converged(diagnostics, rhat_tol, min_ess):
+                        break
+                if segment_dir:
+                    # the temporary files are removed, keep the chains in RAM
+                    param_chain_vec = [
+                        {name: np.array(chain) for name, chain in param_chain.items()}
+                        for param_chain in param_chain_vec
+                    ]
+            else:
+                num_iter = max_iter
+                work_args = [
+                    (
+                        max_iter,
+                        init_args,
+                        mcmc_args,
+                        checkpoint_files[i],
+                        checkpoint_every,
+                        resume_files[i],
+                        chain_files[i],
+                        chain_seeds[i],
+                    )
+                    for i in range(chain_num)
+                ]
+                if not is_parallel:
+                    param_chain_vec = [self._work(*args) for args in work_args]
+                else:
+                    param_chain_vec = Parallel(n_jobs=chain_num)(
+                        delayed(self._work)(*args) for args in work_args
+                    )
+        finally:
+            if is_parallel:
+                self.shared_data_files = None
+                shutil.rmtree(data_dir)
+            if segment_dir:
+                shutil.rmtree(segment_dir)
+        param_chain_vec = [load_param_chain(chain) for chain in param_chain_vec]
+
+        # diagnostics: worst split R-hat and ESS of each block after the burn in
+        burn_in = min(300, int(num_iter / 2))
+        if diagnostics is None:
+            diagnostics = get_chain_diagnostics(param_chain_vec, burn_in, num_iter)
+        self.diagnostics = diagnostics
+        self.iteration_num = num_iter
+        self.is_converged = is_chain_converged(diagnostics, rhat_tol, min_ess)
+        return param_chain_vec, num_iter, burn_in
+
+
 if __name__ == "__main__":
     lc0 = generate_learning_curve(0.05, 0.2, 0.4, 0.4, 5)
     lc1 = generate_learning_curve(0.05, 0.35, 0.25, 0.4, 5)
     print(lc0)
     print(lc1)
+
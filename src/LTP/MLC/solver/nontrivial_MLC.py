@@ -4,8 +4,8 @@ import gevent
 gevent.monkey.patch_all()
 
 
-from ..utl.IO import data_loader_from_file
-from ..utl.utl import Z_assembly, list2array
+from ..utl.IO import data_array_loader_from_file, data_array_loader_from_columns
+from ..utl.utl import Z_assembly_array, get_response_pattern, array2list
 
 
 class RunNontrivialMLC(object):
@@ -29,8 +29,29 @@ class RunNontrivialMLC(object):
         self.max_iteration = 10
 
     def load_data(self, file_path):
-        self.response_data = data_loader_from_file(file_path, self.max_opportunity)
-        self.num_user = len(self.response_data)
+        # parse the file into the padded T*N responses, without a dict per user
+        self.padding_resp, self.bool_resp = data_array_loader_from_file(
+            file_path, self.max_opportunity
+        )
+        self._collapse_response()
+
+    def load_data_from_columns(self, dir_path):
+        # the columns saved by HMM.data_util.write_log_columns
+        self.padding_resp, self.bool_resp = data_array_loader_from_columns(
+            dir_path, self.max_opportunity
+        )
+        self._collapse_response()
+
+    def _collapse_response(self):
+        # users with the same responses share the posterior of the curves
+        self.num_user = self.bool_resp.shape[1]
+        # the response lists of get_predict_performance
+        self.response_data = array2list(self.padding_resp, self.bool_resp)
+        (
+            self.pattern_resp,
+            self.pattern_mask,
+            self.pattern_cnt,
+        ) = get_response_pattern(self.padding_resp, self.bool_resp)
 
     def solve(self):
         # The initial density does not predict convergence, thus the trick is
@@ -65,29 +86,22 @@ class RunNontrivialMLC(object):
         learning_curve_matrix = np.random.uniform(0, 1, (self.max_opportunity, self.K))
         last_learning_curve_matrix = np.array(learning_curve_matrix)
 
-        padding_resp, bool_resp = list2array(
-            self.response_data, self.num_user, self.max_opportunity
-        )
-
         while True:
-            # solve for q
-            z_matrix = np.zeros((self.num_user, self.K))
-            z_dict = dict()
-            for i in range(self.num_user):
-                this_response = self.response_data[i]
-                this_response_tuple = tuple(this_response)
-                dict_lookup = z_dict.get(this_response_tuple)
-                if dict_lookup is None:
-                    dict_lookup = Z_assembly(
-                        this_response, learning_curve_matrix, mixture_density
-                    )
-                    z_dict[this_response_tuple] = dict_lookup
-
-                z_matrix[i, :] = dict_lookup
+            # solve for q, once per unique response sequence
+            z_matrix = Z_assembly_array(
+                self.pattern_resp,
+                self.pattern_mask,
+                learning_curve_matrix,
+                mixture_density,
+            )
+            # weight each sequence by its number of users
+            z_matrix = z_matrix * self.pattern_cnt[:, None]
 
             # solve q_{t+1}
-            numerator = np.dot(padding_resp, z_matrix) + self.alpha - 1
-            denominator = np.dot(bool_resp, z_matrix) + self.alpha + self.beta - 2
+            numerator = np.dot(self.pattern_resp, z_matrix) + self.alpha - 1
+            denominator = (
+                np.dot(self.pattern_mask, z_matrix) + self.alpha + self.beta - 2
+            )
             learning_curve_matrix = numerator / denominator
 
             # solve p_{t+1}
@@ -1,6 +1,6 @@
 import numpy as np
 
-from ..utl.utl import update_mixture_density, predict_response
+from ..utl.utl import update_mixture_density, predict_response, get_response_pattern
 
 
 def forecast_spell_performance(
@@ -54,6 +54,64 @@ def get_predict_performance(
     return forecast_tabs[:, 0] / forecast_tabs[:, 1]
 
 
+def forecast_spell_performance_array(
+    pattern_resp, pattern_mask, learning_curve_matrix, prior_mixture_density=None
+):
+    """
+    forecast_spell_performance of every response sequence at once
+
+    # Input:
+    (1) pattern_resp, pattern_mask: T*P
+    (2) learning_curve_matrix: learning curves, T*J
+    (3) prior_mixture_density: the prior guess of the user type, J*1, sum to 1
+    # Output
+    T*P forecasts
+    """
+    T = pattern_resp.shape[0]
+    J = learning_curve_matrix.shape[1]
+    if T > learning_curve_matrix.shape[0]:
+        raise ValueError("Exceeds the model specification.")
+    if prior_mixture_density is None:
+        prior_mixture_density = np.ones(J) / J
+
+    resp = pattern_resp[:, :, None]
+    lc = learning_curve_matrix[:T, None, :]
+    log_llk = np.where(
+        pattern_mask[:, :, None] == 1,
+        np.log(resp * lc + (1 - resp) * (1 - lc)),
+        0,
+    )
+    # the density at t is updated by the whole prefix at every step before t,
+    # as update_mixture_density is applied to the running density
+    prefix_llk = np.cumsum(log_llk, axis=0)
+    log_density = np.log(prior_mixture_density) + np.concatenate(
+        [np.zeros((1,) + log_llk.shape[1:]), np.cumsum(prefix_llk, axis=0)[:-1]]
+    )
+    log_density -= log_density.max(axis=2, keepdims=True)
+    density = np.exp(log_density)
+    density /= density.sum(axis=2, keepdims=True)
+    return (density * lc).sum(axis=2)
+
+
+def get_predict_performance_array(
+    padding_resp, bool_resp, learning_curve_matrix, prior_mixture_density=None
+):
+    # get_predict_performance on the T*N padded responses, e.g. of RunNontrivialMLC
+    pattern_resp, pattern_mask, pattern_cnt = get_response_pattern(
+        padding_resp, bool_resp
+    )
+    yHats = forecast_spell_performance_array(
+        pattern_resp, pattern_mask, learning_curve_matrix, prior_mixture_density
+    )
+    is_right = (yHats > 0.5).astype(int) == pattern_resp
+    right_cnt = np.dot(is_right * pattern_mask, pattern_cnt)
+    all_cnt = np.dot(pattern_mask, pattern_cnt)
+    if not all_cnt.any():
+        return np.empty((0,))
+    max_T = np.flatnonzero(all_cnt).max() + 1
+    return right_cnt[:max_T] / all_cnt[:max_T]
+
+
 def get_predict(response_lists, learning_curve_matrix, prior_mixture_density=None):
     p_all = []
     y_all = []
@@ -4,6 +4,7 @@ import gevent
 gevent.monkey.patch_all()
 
 from ..utl.IO import data_loader_from_file, data_loader_from_list
+from ..utl.IO import data_loader_from_columns
 from ..utl.utl import Z_assembly
 
 
@@ -35,6 +36,11 @@ class RunVanillaMLC(object):
         self.response_data = data_loader_from_list(log_data, self.max_opportunity)
         self.num_user = len(self.response_data)
 
+    def load_data_from_columns(self, dir_path):
+        # the columns saved by HMM.data_util.write_log_columns
+        self.response_data = data_loader_from_columns(dir_path, self.max_opportunity)
+        self.num_user = len(self.response_data)
+
     def solve(self):
         # The initial density does not predict convergence, thus the trick is
         # just try enough combinations
@@ -1,4 +1,9 @@
 from collections import defaultdict
+from itertools import islice
+
+import numpy as np
+
+from ...HMM.data_util import load_log_columns
 
 
 def data_loader_from_file(file_path, max_opportunity):
@@ -74,3 +79,123 @@ def data_loader_by_userid(log_data, max_opportunity):
         response_data[user_id] = user_response
 
     return response_data
+
+
+def data_loader_from_columns(dir_path, max_opportunity):
+    """
+    # Input
+    The directory written by HMM.data_util.write_log_columns with the columns
+    i (user id), t (practice times) and y (result), mapped instead of parsed
+
+    # output
+    [[Y1,Y2,...,Yt]], in the same order as data_loader_from_file
+    """
+    columns, _ = load_log_columns(dir_path)
+    return group_user_response(
+        columns["i"], columns["t"], columns["y"], max_opportunity
+    )
+
+
+def data_array_loader_from_file(file_path, max_opportunity, chunk_size=1000000):
+    """
+    # Input
+    The same file as data_loader_from_file, parsed chunk_size lines at a time
+
+    # output
+    The padded response matrix and its mask, T*N, as list2array of the output of
+    data_loader_from_file
+    """
+    user_ids = []
+    practice_times = []
+    results = []
+    with open(file_path) as in_f:
+        while True:
+            lines = list(islice(in_f, chunk_size))
+            if not lines:
+                break
+            logs = np.loadtxt(lines, delimiter=",", dtype=np.int64, ndmin=2)
+            if logs.size == 0:
+                continue
+            # drop the late opportunities before the chunk is kept
+            logs = logs[logs[:, 1] <= max_opportunity]
+            user_ids.append(logs[:, 0])
+            practice_times.append(logs[:, 1].astype(np.int32))
+            results.append(logs[:, 2].astype(np.int8))
+
+    if not user_ids:
+        return group_user_response_array([], [], [], max_opportunity)
+    return group_user_response_array(
+        np.concatenate(user_ids),
+        np.concatenate(practice_times),
+        np.concatenate(results),
+        max_opportunity,
+    )
+
+
+def data_array_loader_from_columns(dir_path, max_opportunity):
+    # the padded T*N responses and mask of data_loader_from_columns
+    columns, _ = load_log_columns(dir_path)
+    return group_user_response_array(
+        columns["i"], columns["t"], columns["y"], max_opportunity
+    )
+
+
+def group_user_response(user_ids, practice_times, results, max_opportunity):
+    # the array version of data_loader_from_list
+    user_idx, _, user_results, num_user = _index_user_response(
+        user_ids, practice_times, results, max_opportunity
+    )
+    if num_user == 0:
+        return []
+    user_cnt = np.bincount(user_idx, minlength=num_user)
+    return [
+        user_result.tolist()
+        for user_result in np.split(user_results, np.cumsum(user_cnt)[:-1])
+    ]
+
+
+def group_user_response_array(user_ids, practice_times, results, max_opportunity):
+    # the padded response matrix and mask of group_user_response, T*N
+    user_idx, response_idx, user_results, num_user = _index_user_response(
+        user_ids, practice_times, results, max_opportunity
+    )
+    padding_resp = np.zeros((max_opportunity, num_user), dtype=np.int8, order="F")
+    bool_resp = np.copy(padding_resp, order="F")
+    padding_resp[response_idx, user_idx] = user_results
+    bool_resp[response_idx, user_idx] = 1
+    return padding_resp, bool_resp
+
+
+def _index_user_response(user_ids, practice_times, results, max_opportunity):
+    # users are ordered by their first log, a repeated (i,t) keeps the last result
+    # return the user and the order within the user of each kept result
+    user_ids = np.asarray(user_ids)
+    practice_times = np.asarray(practice_times)
+    results = np.asarray(results)
+    is_kept = practice_times <= max_opportunity
+    user_ids = user_ids[is_kept]
+    practice_times = practice_times[is_kept]
+    results = results[is_kept]
+    if results.size == 0:
+        empty_idx = np.zeros(0, dtype=np.int64)
+        return empty_idx, empty_idx, results, 0
+
+    uniq_ids, first_idx, user_idx = np.unique(
+        user_ids, return_index=True, return_inverse=True
+    )
+    user_rank = np.empty(len(uniq_ids), dtype=np.int64)
+    user_rank[np.argsort(first_idx)] = np.arange(len(uniq_ids))
+    user_idx = user_rank[user_idx]
+
+    order = np.lexsort((np.arange(len(user_idx)), practice_times, user_idx))
+    user_idx = user_idx[order]
+    practice_times = practice_times[order]
+    is_last = np.append(
+        (user_idx[1:] != user_idx[:-1]) | (practice_times[1:] != practice_times[:-1]),
+        True,
+    )
+    user_idx = user_idx[is_last]
+    user_cnt = np.bincount(user_idx, minlength=len(uniq_ids))
+    user_start = np.cumsum(user_cnt) - user_cnt
+    response_idx = np.arange(len(user_idx)) - user_start[user_idx]
+    return user_idx, response_idx, results[order][is_last], len(uniq_ids)
@@ -110,3 +110,52 @@ def list2array(lst, M, N):
             result[i][j] = val
             mask[i][j] = 1
     return result, mask
+
+
+def array2list(padding_resp, bool_resp):
+    # the inverse of list2array, the responses of each user as [Y1,Y2,...,Yt]
+    user_T = bool_resp.sum(axis=0)
+    return [padding_resp[:t, j].tolist() for j, t in enumerate(user_T)]
+
+
+def get_response_pattern(padding_resp, bool_resp):
+    """
+    Collapse the users with the same responses
+
+    # Input:
+    (1) padding_resp, bool_resp: T*N, as from list2array
+    # Output:
+    (1) pattern_resp, pattern_mask: T*P, the unique response sequences
+    (2) pattern_cnt: P, the number of users of each sequence
+    """
+    T = padding_resp.shape[0]
+    patterns, pattern_cnt = np.unique(
+        np.vstack([padding_resp, bool_resp]).T, axis=0, return_counts=True
+    )
+    return patterns[:, :T].T, patterns[:, T:].T, pattern_cnt
+
+
+def Z_assembly_array(
+    pattern_resp, pattern_mask, learning_curve_matrix, mixture_density
+):
+    """
+    Z_assembly of every response sequence at once
+
+    # Input:
+    (1) pattern_resp, pattern_mask: T*P
+    (2) learning curve matrix: T*J
+    (3) mixture density: J*1
+    # Output
+    P*J posterior of the curves
+    """
+    resp = pattern_resp[:, :, None]
+    lc = learning_curve_matrix[:, None, :]
+    # T*P*J, the cells after the end of the sequence do not count
+    log_llk = np.log(resp * lc + (1 - resp) * (1 - lc))
+    log_posterior = np.where(pattern_mask[:, :, None] == 1, log_llk, 0).sum(
+        axis=0
+    ) + np.log(mixture_density)
+    # normalize in the log space, long sequences underflow otherwise
+    log_posterior -= log_posterior.max(axis=1, keepdims=True)
+    posterior = np.exp(log_posterior)
+    return posterior / posterior.sum(axis=1, keepdims=True)
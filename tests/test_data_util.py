@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from LTP.HMM.data_util import (
+    RaggedSeq,
+    load_log_columns,
+    pack_shared_data,
+    unpack_shared_data,
+    write_log_columns,
+)
+from LTP.HMM.util import dump_shared_data, load_shared_data
+
+
+def test_log_columns_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    data = [
+        (i, t, int(rng.integers(300)), int(rng.integers(2)), int(rng.integers(2)))
+        for i in range(50)
+        for t in range(int(rng.integers(1, 4)))
+    ]
+    names = ["i", "t", "j", "y", "e"]
+    header = write_log_columns(data, str(tmp_path), names)
+    columns, id_dict = load_log_columns(str(tmp_path))
+
+    assert header["num_log"] == len(data)
+    assert id_dict == {}
+    assert columns["i"].dtype == np.int8 and columns["j"].dtype == np.int16
+    assert list(zip(*[columns[name].tolist() for name in names])) == data
+
+
+def test_log_columns_round_trip_with_raw_ids(tmp_path):
+    data = [("u2", "q1", 1), ("u0", "q1", 0), ("u2", "q0", 1)]
+    write_log_columns(data, str(tmp_path), ["i", "j", "y"], id_names=["i", "j"])
+    columns, id_dict = load_log_columns(str(tmp_path))
+
+    assert id_dict == {"i": ["u0", "u2"], "j": ["q0", "q1"]}
+    raw = [
+        (id_dict["i"][i], id_dict["j"][j], y)
+        for i, j, y in zip(columns["i"], columns["j"], columns["y"].tolist())
+    ]
+    assert raw == data
+
+    with pytest.raises(Exception):
+        write_log_columns(data, str(tmp_path / "bad"), ["i", "j", "y"])
+
+
+def test_shared_ragged_seq_keeps_index(tmp_path):
+    seq = RaggedSeq.from_logs(
+        [0, 0, 0, 1, 2, 2], [0, 1, 2, 0, 1, 0], {"O": [1, 0, 1, 1, 0, 1]}
+    )
+    files = dump_shared_data(pack_shared_data({"seq": seq}), str(tmp_path))
+    mapped = unpack_shared_data(load_shared_data(files))["seq"]
+
+    assert isinstance(mapped.seq_index, np.memmap)
+    for name in ["offsets", "lengths", "seq_index", "t_index"]:
+        assert np.array_equal(getattr(mapped, name), getattr(seq, name))
+    assert np.array_equal(mapped.to_dense("O", -1), seq.to_dense("O", -1))
+
+    with pytest.raises(ValueError):
+        RaggedSeq.from_logs([0, 2], [0, 0], {"O": [1, 1]})
@@ -0,0 +1,184 @@
+import numpy as np
+import pytest
+
+from LTP.HMM.em import BKT_HMM_EM
+
+
+def simulate_bkt(num_learner, max_T, seed):
+    rng = np.random.default_rng(seed)
+    data = []
+    for i in range(num_learner):
+        x = int(rng.random() < 0.3)
+        for t in range(int(rng.integers(1, max_T + 1))):
+            if t > 0 and x == 0:
+                x = int(rng.random() < 0.2)
+            y = int(rng.random() < [0.25, 0.85][x])
+            data.append((i, t, 0, y))
+    return data
+
+
+def em_update_by_sequence(param, response_lists):
+    # one Baum-Welch step, learner by learner
+    s, g, pi, l = param["s"], param["g"], param["pi"], param["l"]
+    A = np.array([[1 - l, l], [0, 1]])
+    B = np.array([[1 - g, g], [s, 1 - s]])
+    pi_sum, l_num, l_den = 0.0, 0.0, 0.0
+    s_num, s_den, g_num, g_den = 0.0, 0.0, 0.0, 0.0
+    for Y in response_lists:
+        T = len(Y)
+        a = np.zeros((T, 2))
+        b = np.ones((T, 2))
+        a[0] = np.array([1 - pi, pi]) * B[:, Y[0]]
+        for t in range(1, T):
+            a[t] = np.dot(a[t - 1], A) * B[:, Y[t]]
+        for t in range(T - 2, -1, -1):
+            b[t] = np.dot(A, B[:, Y[t + 1]] * b[t + 1])
+        gamma = a * b / (a * b).sum(axis=1, keepdims=True)
+        pi_sum += gamma[0, 1]
+        for t in range(T - 1):
+            xi = a[t][:, None] * A * (B[:, Y[t + 1]] * b[t + 1])[None, :]
+            l_num += xi[0, 1] / xi.sum()
+            l_den += gamma[t, 0]
+        for t in range(T):
+            s_num += gamma[t, 1] * (Y[t] == 0)
+            s_den += gamma[t, 1]
+            g_num += gamma[t, 0] * (Y[t] == 1)
+            g_den += gamma[t, 0]
+    return {
+        "s": s_num / s_den,
+        "g": g_num / g_den,
+        "pi": pi_sum / len(response_lists),
+        "l": l_num / l_den,
+    }
+
+
+@pytest.mark.parametrize("is_scaled", [False, True])
+def test_em_matches_per_sequence_update(is_scaled):
+    # few short spells, so that many learners share a response sequence
+    data = simulate_bkt(300, 4, seed=1)
+    response_lists = [[] for _ in range(300)]
+    for i, t, j, y in data:
+        response_lists[i].append(y)
+
+    init_param = {"s": 0.1, "g": 0.2, "pi": 0.4, "l": 0.3}
+    param = dict(init_param)
+    for _ in range(3):
+        param = em_update_by_sequence(param, response_lists)
+
+    model = BKT_HMM_EM()
+    s, g, pi, l = model.estimate(init_param, data, max_iter=3, is_scaled=is_scaled)
+    assert model.obs_type_num < model.K
+    assert np.allclose([s, g, pi, l], [param[x] for x in ["s", "g", "pi", "l"]])
+
+
+def test_em_scaled_matches_unscaled():
+    data = simulate_bkt(200, 8, seed=2)
+    init_param = {"s": 0.1, "g": 0.2, "pi": 0.4, "l": 0.3}
+    res = BKT_HMM_EM().estimate(init_param, data, max_iter=5)
+    res_scaled = BKT_HMM_EM().estimate(init_param, data, max_iter=5, is_scaled=True)
+    assert np.allclose(res, res_scaled)
+
+
+def test_em_ignores_extra_columns():
+    # the (i,t,j,y,h,e) logs of the MCMC, as tuples and as an array
+    data = simulate_bkt(100, 6, seed=3)
+    data_he = [(i, t, j, y, 0, 1) for i, t, j, y in data]
+    init_param = {"s": 0.1, "g": 0.2, "pi": 0.4, "l": 0.3}
+    res = BKT_HMM_EM().estimate(init_param, data, max_iter=3)
+    for log_data in [data_he, np.array(data_he)]:
+        assert np.allclose(
+            BKT_HMM_EM().estimate(init_param, log_data, max_iter=3), res
+        )
+
+
+def predict_by_sequence(param, Y):
+    # P(Y_t=1|Y_0,...,Y_{t-1}), filtering one response at a time
+    s, g, pi, l = param["s"], param["g"], param["pi"], param["l"]
+    yHats = []
+    mastery = pi
+    for y in Y:
+        yHats.append(mastery * (1 - s) + (1 - mastery) * g)
+        if y == 1:
+            mastery = mastery * (1 - s) / yHats[-1]
+        else:
+            mastery = mastery * s / (1 - yHats[-1])
+        mastery = mastery + (1 - mastery) * l
+    return yHats
+
+
+def test_predict_array_matches_predict():
+    data = simulate_bkt(100, 6, seed=4)
+    response_lists = [[] for _ in range(100)]
+    for i, t, j, y in data:
+        response_lists[i].append(y)
+    param = {"s": 0.15, "g": 0.25, "pi": 0.35, "l": 0.2}
+
+    # predicting leaves the unscaled mode of a fitted model
+    model = BKT_HMM_EM()
+    model.estimate(param, data, max_iter=1)
+    yHat = model.predict_array(param, data)
+    assert not model.is_scaled
+    for k, Y in enumerate(response_lists):
+        assert np.allclose(yHat[: len(Y), k], predict_by_sequence(param, Y))
+        assert np.isnan(yHat[len(Y) :, k]).all()
+
+    expected = [
+        (yHat[t, k], Y[t])
+        for k, Y in enumerate(response_lists)
+        for t in range(1, len(Y))
+    ]
+    assert np.allclose(model.predict(param, data), expected)
+
+
+def test_estimate_many_matches_serial_fit():
+    # each skill sees a scattered subset of the learner ids
+    data_by_skill = {}
+    for skill, seed in [("add", 5), ("sub", 6), ("mul", 7)]:
+        rng = np.random.default_rng(seed)
+        learner_ids = np.sort(rng.choice(1000, size=80, replace=False))
+        data_by_skill[skill] = [
+            (int(learner_ids[i]), t, j, y) for i, t, j, y in simulate_bkt(80, 6, seed)
+        ]
+    init_param = {"s": 0.1, "g": 0.2, "pi": 0.4, "l": 0.3}
+
+    res = BKT_HMM_EM.estimate_many(init_param, data_by_skill, max_iter=4, n_jobs=2)
+    assert sorted(res) == sorted(data_by_skill)
+    for skill, data in data_by_skill.items():
+        id_map = {i: k for k, i in enumerate(sorted(set(log[0] for log in data)))}
+        skill_data = [(id_map[i], t, j, y) for i, t, j, y in data]
+        expected = BKT_HMM_EM().estimate(init_param, skill_data, max_iter=4)
+        assert np.allclose(res[skill], expected)
+
+
+def test_em_stops_at_tol():
+    data = simulate_bkt(200, 8, seed=8)
+    init_param = {"s": 0.1, "g": 0.2, "pi": 0.4, "l": 0.3}
+    model = BKT_HMM_EM()
+    res = model.estimate(init_param, data, max_iter=500, tol=1e-6)
+    assert model.is_converged
+    assert 1 < model.iteration_num < 500
+    assert len(model.llk_trajectory) == model.iteration_num
+    llk_change = np.abs(np.diff(model.llk_trajectory) / model.llk_trajectory[:-1])
+    assert llk_change[-1] <= 1e-6 and (llk_change[:-1] > 1e-6).all()
+
+    # the same iterations without tol
+    full = BKT_HMM_EM()
+    res_full = full.estimate(init_param, data, max_iter=model.iteration_num)
+    assert not full.is_converged
+    assert full.iteration_num == model.iteration_num
+    assert np.allclose(res, res_full)
+
+
+def test_em_warm_start_continues():
+    data = simulate_bkt(200, 8, seed=9)
+    init_param = {"s": 0.1, "g": 0.2, "pi": 0.4, "l": 0.3}
+    res = BKT_HMM_EM().estimate(init_param, data, max_iter=5)
+
+    model = BKT_HMM_EM()
+    model.estimate(init_param, data, max_iter=3)
+    # init_param is ignored once the model has been fitted
+    other_param = {"s": 0.3, "g": 0.3, "pi": 0.5, "l": 0.1}
+    res_warm = model.estimate(other_param, data, max_iter=2, warm_start=True)
+    assert np.allclose(res_warm, res)
+    res_cold = BKT_HMM_EM().estimate(other_param, data, max_iter=2, warm_start=True)
+    assert not np.allclose(res_cold, res)
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from LTP.HMM.bfs_util import generate_states, update_state_parmeters
+from LTP.HMM.ffbs_util import forward_filtering
+from LTP.HMM.util import logExpSum
+
+
+def get_spell_args(Mx, T, is_effort, is_exit, hazard_state, seed):
+    rng = np.random.default_rng(seed)
+    J = 2
+    My = 2
+    state_init_dist = rng.dirichlet(np.ones(Mx))
+    # no regression in the latent state
+    state_transit_matrix = np.triu(rng.uniform(0.1, 1, (J, 2, Mx, Mx)))
+    state_transit_matrix /= state_transit_matrix.sum(axis=3, keepdims=True)
+    observ_prob_matrix = rng.dirichlet(np.ones(My), (J, Mx))
+    effort_prob_matrix = rng.dirichlet(np.ones(2), (J, Mx))
+    hazard_matrix = rng.uniform(0.05, 0.3, (max(Mx, My), T))
+
+    E = rng.integers(0, 2, T).tolist() if is_effort else [1] * T
+    O = [int(rng.integers(My)) if e else 0 for e in E]
+    J_vec = rng.integers(0, J, T).tolist()
+    return (
+        O,
+        E,
+        1,
+        J_vec,
+        J_vec,
+        hazard_matrix,
+        observ_prob_matrix,
+        state_init_dist,
+        state_transit_matrix,
+        effort_prob_matrix,
+        is_effort,
+        is_exit,
+        hazard_state,
+    )
+
+
+@pytest.mark.parametrize("Mx", [2, 3])
+@pytest.mark.parametrize("T", [1, 2, 5])
+@pytest.mark.parametrize(
+    "is_effort,is_exit,hazard_state",
+    [(False, False, "X"), (True, False, "X"), (True, True, "X"), (False, True, "Y")],
+)
+def test_forward_filtering_matches_bfs(Mx, T, is_effort, is_exit, hazard_state):
+    args = get_spell_args(Mx, T, is_effort, is_exit, hazard_state, seed=T * 10 + Mx)
+    X_mat = generate_states(T, Mx, Mx - 1)
+    llk_bfs, pis_bfs, l_mat_bfs = update_state_parmeters(X_mat, Mx, *args)
+    llk_ffbs, pis_ffbs, l_mat_ffbs = forward_filtering(Mx, *args)
+
+    assert np.isclose(logExpSum(llk_bfs), logExpSum(llk_ffbs))
+    assert np.allclose(pis_bfs, pis_ffbs)
+    # P(X_{t-1}|X_t) is the same given the past or the whole spell
+    assert np.allclose(l_mat_bfs, l_mat_ffbs)
@@ -0,0 +1,174 @@
+import numpy as np
+import pytest
+
+from LTP import LTP_HMM_MCMC, DIRT_MCMC
+
+
+@pytest.fixture(scope="module")
+def hmm_data():
+    # (i,t,j,y,h,e) of a 2-state BKT with effort and exit
+    rng = np.random.default_rng(1)
+    data = []
+    for i in range(150):
+        T = int(rng.integers(1, 5))
+        x = int(rng.random() < 0.4)
+        for t in range(T):
+            if t > 0 and x == 0:
+                x = int(rng.random() < 0.3)
+            e = int(rng.random() < [0.7, 0.9][x])
+            y = int(rng.random() < [0.2, 0.8][x]) if e else 0
+            h = int(t == T - 1 and rng.random() < 0.5)
+            data.append((i, t, int(rng.integers(3)), y, h, e))
+    return data
+
+
+@pytest.fixture(scope="module")
+def dirt_data():
+    rng = np.random.default_rng(2)
+    data = []
+    for i in range(100):
+        theta = int(rng.random() < 0.5)
+        for j in range(5):
+            if rng.random() < 0.8:
+                y = int(rng.random() < [0.3, 0.8][theta])
+                data.append(("u%d" % i, "q%d" % j, y))
+    return data
+
+
+def is_same_chain(a, b):
+    return sorted(a.param_chain) == sorted(b.param_chain) and all(
+        np.array_equal(a.param_chain[name], b.param_chain[name])
+        for name in a.param_chain
+    )
+
+
+HMM_OPTIONS = [
+    dict(is_effort=True, is_exit=True),
+    dict(is_exit=True, hazard_model="prop", method="FFBS"),
+]
+
+
+@pytest.mark.parametrize("options", HMM_OPTIONS)
+def test_seeded_chains_are_reproducible(hmm_data, tmp_path, options):
+    kwargs = dict(chain_num=2, max_iter=12, seed=7, **options)
+    serial = LTP_HMM_MCMC()
+    serial.estimate(hmm_data, is_parallel=False, **kwargs)
+
+    parallel = LTP_HMM_MCMC()
+    parallel.estimate(hmm_data, is_parallel=True, **kwargs)
+    assert is_same_chain(serial, parallel)
+
+    mapped = LTP_HMM_MCMC()
+    mapped.estimate(hmm_data, chain_dir=str(tmp_path / "chain"), **kwargs)
+    assert is_same_chain(serial, mapped)
+
+    # stop half way, then pick up from the checkpoint
+    checkpoint = str(tmp_path / "chk")
+    LTP_HMM_MCMC().estimate(
+        hmm_data,
+        is_parallel=False,
+        checkpoint_path=checkpoint,
+        checkpoint_every=4,
+        **dict(kwargs, max_iter=6)
+    )
+    resumed = LTP_HMM_MCMC()
+    resumed.estimate(hmm_data, resume_from=checkpoint, **kwargs)
+    assert is_same_chain(serial, resumed)
+
+    # the segments of the early stop check never stop with an unreachable ESS
+    segmented = LTP_HMM_MCMC()
+    segmented.estimate(
+        hmm_data, is_early_stop=True, diagnose_every=5, min_ess=1e9, **kwargs
+    )
+    assert is_same_chain(serial, segmented)
+
+    other = LTP_HMM_MCMC()
+    other.estimate(hmm_data, is_parallel=False, **dict(kwargs, seed=8))
+    assert not is_same_chain(serial, other)
+
+
+def test_seeded_dirt_chains_are_reproducible(dirt_data, tmp_path):
+    kwargs = dict(chain_num=2, max_iter=12, seed=3, is_robust=True)
+    serial = DIRT_MCMC()
+    serial.estimate(dirt_data, is_parallel=False, **kwargs)
+
+    parallel = DIRT_MCMC()
+    parallel.estimate(dirt_data, is_parallel=True, **kwargs)
+    assert is_same_chain(serial, parallel)
+
+    checkpoint = str(tmp_path / "chk")
+    DIRT_MCMC().estimate(
+        dirt_data,
+        is_parallel=False,
+        checkpoint_path=checkpoint,
+        checkpoint_every=5,
+        **dict(kwargs, max_iter=7)
+    )
+    resumed = DIRT_MCMC()
+    resumed.estimate(dirt_data, resume_from=checkpoint, **kwargs)
+    assert is_same_chain(serial, resumed)
+
+
+@pytest.mark.parametrize("estimator", ["hmm", "dirt"])
+def test_early_stop_resume_of_finished_chain(hmm_data, dirt_data, tmp_path, estimator):
+    # the checkpoint already has max_iter rows, no segment is left to run
+    if estimator == "hmm":
+        model_class, data = LTP_HMM_MCMC, hmm_data
+    else:
+        model_class, data = DIRT_MCMC, dirt_data
+    checkpoint = str(tmp_path / "chk")
+    finished = model_class()
+    finished.estimate(
+        data,
+        chain_num=2,
+        max_iter=6,
+        is_parallel=False,
+        checkpoint_path=checkpoint,
+        seed=3,
+    )
+    resumed = model_class()
+    resumed.estimate(
+        data,
+        chain_num=2,
+        max_iter=6,
+        is_parallel=False,
+        resume_from=checkpoint,
+        is_early_stop=True,
+        diagnose_every=3,
+    )
+    assert is_same_chain(finished, resumed)
+    assert resumed.iteration_num == 6
+    assert resumed.diagnostics == finished.diagnostics
+
+
+def test_last_states_are_dense(hmm_data):
+    model = LTP_HMM_MCMC()
+    model.estimate(hmm_data, chain_num=1, max_iter=3, is_parallel=False, seed=3)
+    lengths = np.bincount([log[0] for log in hmm_data])
+    assert model.X.shape == (lengths.max(), len(lengths))
+    is_padded = np.arange(lengths.max())[:, None] >= lengths[None, :]
+    assert not model.X[is_padded].any()
+    assert set(np.unique(model.X)) <= {0, 1}
+
+
+
+def test_sparse_matches_dense():
+    # the item of each period is fixed, so that few response patterns cover
+    # enough learners for a narrow posterior
+    rng = np.random.default_rng(11)
+    data = []
+    for i in range(2000):
+        x = int(rng.random() < 0.3)
+        for t in range(int(rng.integers(2, 5))):
+            if t > 0 and x == 0:
+                x = int(rng.random() < [0.2, 0.3, 0.4][t % 3])
+            data.append((i, t, t % 3, int(rng.random() < [0.2, 0.85][x])))
+
+    # the redraws of an invalid c take the rng in another order, so the chains
+    # part after the first one, but they share the posterior
+    kwargs = dict(chain_num=2, max_iter=300, is_parallel=False, seed=5)
+    res = LTP_HMM_MCMC().estimate(data, **kwargs)
+    res_sparse = LTP_HMM_MCMC().estimate(data, is_sparse=True, **kwargs)
+    assert sorted(res_sparse) == sorted(res)
+    for name in res:
+        assert np.allclose(res_sparse[name], res[name], atol=0.05)
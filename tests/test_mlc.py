@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+from LTP.HMM.data_util import write_log_columns
+from LTP.MLC.solver.predict_performance import (
+    get_predict_performance,
+    get_predict_performance_array,
+)
+from LTP.MLC.utl.IO import (
+    data_array_loader_from_columns,
+    data_array_loader_from_file,
+    data_loader_from_file,
+)
+from LTP.MLC.utl.utl import (
+    Z_assembly,
+    Z_assembly_array,
+    array2list,
+    get_response_pattern,
+    list2array,
+)
+
+
+def write_response_file(file_path, num_log, seed):
+    # user_id,practice_times,result, with blank lines in between
+    rng = np.random.default_rng(seed)
+    logs = [
+        (int(rng.integers(300)), int(rng.integers(1, 8)), int(rng.random() < 0.6))
+        for _ in range(num_log)
+    ]
+    with open(file_path, "w") as f:
+        for k, log in enumerate(logs):
+            f.write("%d,%d,%d\n" % log)
+            if k % 97 == 5:
+                f.write("\n")
+    return logs
+
+
+@pytest.mark.parametrize("num_log,chunk_size", [(2000, 77), (2000, 10000), (0, 10)])
+def test_chunked_loader_matches_list_loader(tmp_path, num_log, chunk_size):
+    file_path = str(tmp_path / "resp.csv")
+    logs = write_response_file(file_path, num_log, seed=num_log)
+    response_lists = data_loader_from_file(file_path, 5)
+    padding_ref, bool_ref = list2array(response_lists, len(response_lists), 5)
+
+    padding_resp, bool_resp = data_array_loader_from_file(file_path, 5, chunk_size)
+    assert np.array_equal(padding_resp, padding_ref)
+    assert np.array_equal(bool_resp, bool_ref)
+
+    if num_log:
+        write_log_columns(logs, str(tmp_path / "columns"), ["i", "t", "y"])
+        padding_col, bool_col = data_array_loader_from_columns(
+            str(tmp_path / "columns"), 5
+        )
+        assert np.array_equal(padding_col, padding_ref)
+        assert np.array_equal(bool_col, bool_ref)
+
+
+def test_pattern_functions_match_list_functions(tmp_path):
+    file_path = str(tmp_path / "resp.csv")
+    write_response_file(file_path, 2000, seed=1)
+    response_lists = data_loader_from_file(file_path, 5)
+    padding_resp, bool_resp = data_array_loader_from_file(file_path, 5)
+    learning_curve_matrix = np.array(
+        [[0.2, 0.8], [0.4, 0.8], [0.6, 0.8], [0.8, 0.8], [0.9, 0.8]]
+    )
+    mixture_density = np.array([0.7, 0.3])
+
+    pattern_resp, pattern_mask, pattern_cnt = get_response_pattern(
+        padding_resp, bool_resp
+    )
+    assert pattern_cnt.sum() == len(response_lists)
+    z_pattern = Z_assembly_array(
+        pattern_resp, pattern_mask, learning_curve_matrix, mixture_density
+    )
+    for p in range(len(pattern_cnt)):
+        response_list = pattern_resp[: pattern_mask[:, p].sum(), p].tolist()
+        z = Z_assembly(response_list, learning_curve_matrix, mixture_density)
+        assert np.allclose(z_pattern[p], z)
+
+    for prior in [None, mixture_density]:
+        assert np.allclose(
+            get_predict_performance_array(
+                padding_resp, bool_resp, learning_curve_matrix, prior
+            ),
+            get_predict_performance(response_lists, learning_curve_matrix, prior),
+        )
+
+
+def test_array2list_restores_response_lists(tmp_path):
+    file_path = str(tmp_path / "resp.csv")
+    write_response_file(file_path, 2000, seed=2)
+    response_lists = data_loader_from_file(file_path, 5)
+    padding_resp, bool_resp = data_array_loader_from_file(file_path, 5)
+    assert array2list(padding_resp, bool_resp) == response_lists
+
+
+def test_predict_performance_of_no_response():
+    padding_resp = np.zeros((5, 0), dtype=np.int8)
+    learning_curve_matrix = np.full((5, 2), 0.5)
+    res = get_predict_performance_array(
+        padding_resp, padding_resp, learning_curve_matrix
+    )
+    assert res.shape == (0,)
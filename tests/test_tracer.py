@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from LTP.HMM.tracer import BKT_Tracer
+from LTP.HMM.util import compute_success_rate, forward_update_mastery
+
+PARAM = {"s": [0.1, 0.2], "g": [0.2, 0.3], "pi": [0.3, 0.4], "l": [0.1, 0.25]}
+
+
+def get_events(num_event, seed):
+    rng = np.random.default_rng(seed)
+    # few learners, so that a batch has several events of the same learner/skill
+    learner_ids = rng.integers(0, 4, num_event)
+    skill_ids = rng.integers(0, 2, num_event)
+    Y = rng.integers(0, 2, num_event)
+    return learner_ids, skill_ids, Y
+
+
+def trace_step_by_step(learner_ids, skill_ids, Y):
+    mastery = {}
+    yHat = []
+    for i, j, y in zip(learner_ids, skill_ids, Y):
+        m = mastery.get((i, j), PARAM["pi"][j])
+        m = forward_update_mastery(m, PARAM["s"][j], PARAM["g"][j], PARAM["l"][j], y)
+        mastery[(i, j)] = m
+        yHat.append(compute_success_rate(PARAM["s"][j], PARAM["g"][j], m))
+    return mastery, np.array(yHat)
+
+
+@pytest.mark.parametrize("batch_size", [1, 7, 40])
+def test_update_matches_step_by_step(batch_size):
+    learner_ids, skill_ids, Y = get_events(40, seed=batch_size)
+    mastery, yHat_ref = trace_step_by_step(learner_ids, skill_ids, Y)
+
+    tracer = BKT_Tracer(PARAM)
+    yHat = np.concatenate(
+        [
+            tracer.update(
+                learner_ids[k : k + batch_size],
+                skill_ids[k : k + batch_size],
+                Y[k : k + batch_size],
+            )
+            for k in range(0, 40, batch_size)
+        ]
+    )
+    # each event is predicted from the state right after it
+    assert np.allclose(yHat, yHat_ref)
+
+    keys = sorted(mastery)
+    learners = [i for i, j in keys]
+    skills = [j for i, j in keys]
+    assert np.allclose(tracer.get_mastery(learners, skills), [mastery[k] for k in keys])
+    yHat_last = [
+        compute_success_rate(PARAM["s"][j], PARAM["g"][j], mastery[(i, j)])
+        for i, j in keys
+    ]
+    assert np.allclose(tracer.predict(learners, skills), yHat_last)
+
+
+def test_unseen_learner_is_at_prior():
+    tracer = BKT_Tracer(PARAM)
+    tracer.update([0], [1], [1])
+    assert np.allclose(tracer.get_mastery([0, 9, 9], [0, 0, 1]), [0.3, 0.3, 0.4])
+
+
+def test_invalid_batch_leaves_the_state_unchanged():
+    tracer = BKT_Tracer(PARAM, num_learner=2)
+    tracer.update([0, 1], [0, 1], [1, 0])
+    mastery = tracer.mastery[: tracer.num_learner].copy()
+
+    for learner_ids, skill_ids, Y in [
+        ([0, 0, 5], [0, 0, 1], [1, 0, 2]),
+        ([0, -1], [0, 1], [1, 1]),
+        ([0, 1], [0, 2], [1, 1]),
+    ]:
+        with pytest.raises(ValueError):
+            tracer.update(learner_ids, skill_ids, Y)
+        assert tracer.num_learner == 2
+        assert np.array_equal(tracer.mastery[:2], mastery)
+
+    for learner_ids, skill_ids in [([-1], [0]), ([0], [-1]), ([0], [2])]:
+        with pytest.raises(ValueError):
+            tracer.get_mastery(learner_ids, skill_ids)
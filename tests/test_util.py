@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from LTP.HMM.util import (
+    get_chain_diagnostics,
+    get_ess,
+    get_split_rhat,
+    is_chain_converged,
+)
+
+
+def draw_chains(seed, num_chain=4, num_iter=1000, num_param=3, phi=0.0):
+    # AR(1) chains, i.i.d. normal at phi=0
+    rng = np.random.default_rng(seed)
+    noise = rng.standard_normal((num_chain, num_iter, num_param))
+    chains = np.empty_like(noise)
+    chains[:, 0] = noise[:, 0]
+    for n in range(1, num_iter):
+        chains[:, n] = phi * chains[:, n - 1] + np.sqrt(1 - phi**2) * noise[:, n]
+    return chains
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_iid_chains_mix(seed):
+    chains = draw_chains(seed)
+    assert np.allclose(get_split_rhat(chains), 1, atol=0.01)
+    ess = get_ess(chains)
+    assert ((ess > 0.7 * 4000) & (ess < 1.3 * 4000)).all()
+
+
+def test_correlated_chains_have_small_ess():
+    # the ESS of an AR(1) is about n(1-phi)/(1+phi), n/19 at phi=0.9
+    for seed in range(10):
+        ess = get_ess(draw_chains(seed, phi=0.9))
+        assert ((ess > 4000 / 19 / 10) & (ess < 4000 / 10)).all()
+
+
+def test_shifted_chains_do_not_mix():
+    chains = draw_chains(4) + np.arange(4)[:, None, None]
+    assert (get_split_rhat(chains) > 1.1).all()
+
+    # a trend within each chain shows in the split halves
+    trend = draw_chains(5) + np.linspace(0, 2, 1000)[None, :, None]
+    assert (get_split_rhat(trend) > 1.1).all()
+
+
+def test_constant_chains():
+    chains = np.ones((4, 100, 2))
+    assert np.array_equal(get_split_rhat(chains), np.ones(2))
+    assert np.array_equal(get_ess(chains), np.full(2, 400.0))
+
+
+def test_chain_diagnostics():
+    iid = draw_chains(6, num_param=150)
+    param_chain_vec = [{"l": chain, "h": chain[:, 0:0]} for chain in iid]
+    diagnostics = get_chain_diagnostics(param_chain_vec, 0, 1000, col_size=40)
+    assert sorted(diagnostics) == ["l"]
+    assert diagnostics["l"]["rhat"] == get_split_rhat(iid).max()
+    assert diagnostics["l"]["ess"] == get_ess(iid).min()
+    assert is_chain_converged(diagnostics, 1.01, 400)
+    assert not is_chain_converged(diagnostics, 1.01, 10000)
+
+    shifted = iid + np.arange(4)[:, None, None]
+    param_chain_vec = [{"l": chain} for chain in shifted]
+    diagnostics = get_chain_diagnostics(param_chain_vec, 500, 1000)
+    assert diagnostics["l"]["rhat"] > 1.1
+    assert not is_chain_converged(diagnostics, 1.01, 400)
+
+    # too few iterations to diagnose
+    assert get_chain_diagnostics(param_chain_vec, 0, 3) == {}
+    assert not is_chain_converged({}, 1.01, 400)